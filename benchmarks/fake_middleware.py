@@ -0,0 +1,587 @@
+#!/usr/bin/env python3
+"""
+Fake TrueNAS middleware for offline benchmarks.
+
+Serves the JSON-RPC 2.0 websocket API used by truenas_api_client (/api/current),
+a plain HTTP endpoint used by the bundled midclt shim, and file downloads for
+core.download. Latency, app counts, upgrade durations, failure rates and backup
+sizes are configurable so the scripts can be timed without a TrueNAS system.
+"""
+
+import argparse
+import base64
+import hashlib
+import io
+import itertools
+import json
+import os
+import random
+import socketserver
+import ssl
+import struct
+import tarfile
+import threading
+import time
+from urllib.parse import urlparse
+
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+
+class CallError(Exception):
+    """Raised by a fake method to return a JSON-RPC error to the caller."""
+
+
+def get_field(item, name):
+    for part in name.split("."):
+        if not isinstance(item, dict) or part not in item:
+            return None
+        item = item[part]
+    return item
+
+
+def filter_list(items, filters=None, options=None):
+    """Apply middleware-style query filters (including OR) and options (select, get, count, limit)."""
+    operators = {
+        "=": lambda a, b: a == b,
+        "!=": lambda a, b: a != b,
+        ">": lambda a, b: a is not None and a > b,
+        "<": lambda a, b: a is not None and a < b,
+        "in": lambda a, b: a in b,
+        "nin": lambda a, b: a not in b,
+        "^": lambda a, b: isinstance(a, str) and a.startswith(b),
+        "$": lambda a, b: isinstance(a, str) and a.endswith(b),
+    }
+
+    def matches(item, query_filter):
+        if query_filter[0] == "OR":
+            return any(matches(item, branch) if branch and isinstance(branch[0], str)
+                       else all(matches(item, f) for f in branch)
+                       for branch in query_filter[1])
+        name, op, value = query_filter
+        return operators[op](get_field(item, name), value)
+
+    options = options or {}
+    result = [item for item in items if all(matches(item, f) for f in (filters or []))]
+    if options.get("limit"):
+        result = result[:options["limit"]]
+    if options.get("select"):
+        selected = []
+        for item in result:
+            entry = {}
+            for name in options["select"]:
+                value = get_field(item, name)
+                target = entry
+                parts = name.split(".")
+                for part in parts[:-1]:
+                    target = target.setdefault(part, {})
+                target[parts[-1]] = value
+            selected.append(entry)
+        result = selected
+    if options.get("count"):
+        return len(result)
+    if options.get("get"):
+        if not result:
+            raise CallError("Instance not found")
+        return result[0]
+    return result
+
+
+def fake_pool(name, vdev_type, vdevs, width, size, free, cache=0):
+    """Build a pool.query entry with the given data vdev layout and optional cache devices."""
+    def disk(index):
+        return {"type": "DISK", "name": f"{name}-disk{index}", "children": []}
+
+    if vdev_type == "DISK":
+        data = [disk(index) for index in range(vdevs)]
+    else:
+        data = [{"type": vdev_type, "name": f"{vdev_type.lower()}-{index}",
+                 "children": [disk(index * width + child) for child in range(width)]}
+                for index in range(vdevs)]
+    return {
+        "name": name, "status": "ONLINE", "size": size, "size_str": str(size), "free": free, "free_str": str(free),
+        "topology": {"data": data, "log": [], "cache": [disk(100 + index) for index in range(cache)],
+                     "spare": [], "special": [], "dedup": []},
+    }
+
+
+class FakeMiddleware:
+    """In-memory middleware state and method implementations."""
+
+    def __init__(self, apps=50, upgradable_ratio=0.5, custom_ratio=0.1, latency=0.0,
+                 upgrade_duration=0.5, pull_duration=0.2, sync_duration=1.0, failure_rate=0.0,
+                 backup_size=1024 * 1024, ui_port=0, interrupted_downloads=0, seed=0):
+        self.latency = latency
+        self.upgrade_duration = upgrade_duration
+        self.pull_duration = pull_duration
+        self.sync_duration = sync_duration
+        self.failure_rate = failure_rate
+        self.backup_size = backup_size
+        self.ui_port = ui_port
+        # The first N downloads are cut off half way through to exercise resume.
+        self.interrupted_downloads = interrupted_downloads
+        self.config_revision = 0
+        self._backup = None
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.job_ids = itertools.count(1)
+        self.jobs = {}
+        self.downloads = {}
+        self.init_scripts = []
+        self.certificates = []
+        self.ui_certificate = None
+        self.ui_restarts = 0
+        self.connections = set()
+        self.calls = 0
+        self.pools = [
+            fake_pool("nvme", "MIRROR", vdevs=1, width=2, size=1013612347392, free=877498318848),
+            fake_pool("data", "MIRROR", vdevs=6, width=2, size=83354851770368, free=62705565663232, cache=1),
+            fake_pool("scratch", "DISK", vdevs=1, width=0, size=499289948160, free=499289948160),
+        ]
+        self.apps = []
+        for index in range(apps):
+            name = f"app{index:04d}"
+            self.apps.append({
+                "name": name,
+                "id": name,
+                "state": "RUNNING",
+                "version": "1.0.0",
+                "human_version": "1.0.0_1.0.0",
+                "upgrade_available": index < apps * upgradable_ratio,
+                "custom_app": index >= apps - int(apps * custom_ratio),
+                "metadata": {"name": name, "train": "stable", "description": "x" * 512},
+                "active_workloads": {"containers": 1, "images": [f"example/{name}:1.0.0"]},
+                "notes": "n" * 1024,
+            })
+
+    def call(self, connection, method, params):
+        with self.lock:
+            self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        handler = getattr(self, "method_" + method.replace(".", "_"), None)
+        if handler is None:
+            if method.startswith("core."):
+                return None
+            raise CallError(f"Method {method} not found")
+        if getattr(handler, "needs_connection", False):
+            return handler(connection, *params)
+        return handler(*params)
+
+    # Jobs
+
+    def start_job(self, method, arguments, func, duration):
+        job_id = next(self.job_ids)
+        job = {
+            "id": job_id,
+            "method": method,
+            "arguments": list(arguments),
+            "state": "RUNNING",
+            "progress": {"percent": 0, "description": ""},
+            "result": None,
+            "error": None,
+            "time_started": time.time(),
+            "time_finished": None,
+        }
+        with self.lock:
+            self.jobs[job_id] = job
+
+        def run():
+            time.sleep(duration)
+            try:
+                if self.random.random() < self.failure_rate:
+                    raise CallError(f"Simulated {method} failure")
+                job["result"] = func()
+                job["state"] = "SUCCESS"
+            except CallError as e:
+                job["error"] = str(e)
+                job["state"] = "FAILED"
+            job["progress"]["percent"] = 100
+            job["time_finished"] = time.time()
+            self.publish("core.get_jobs", "changed", job_id, job)
+
+        threading.Thread(target=run, daemon=True).start()
+        return job_id
+
+    def wait_job(self, job_id):
+        while self.jobs[job_id]["state"] == "RUNNING":
+            time.sleep(0.01)
+        job = self.jobs[job_id]
+        if job["state"] != "SUCCESS":
+            raise CallError(job["error"])
+        return job["result"]
+
+    def publish(self, collection, msg, ident, fields):
+        for connection in list(self.connections):
+            if collection in connection.subscriptions:
+                connection.send_json({
+                    "jsonrpc": "2.0",
+                    "method": "collection_update",
+                    "params": {"msg": msg, "collection": collection, "id": ident, "fields": fields},
+                })
+
+    def method_core_get_jobs(self, filters=None, options=None):
+        with self.lock:
+            jobs = list(self.jobs.values())
+        return filter_list(jobs, filters, options)
+
+    def method_core_subscribe(self, connection, name):
+        connection.subscriptions.add(name)
+        return name
+    method_core_subscribe.needs_connection = True
+
+    def method_core_unsubscribe(self, connection, ident):
+        connection.subscriptions.discard(ident)
+    method_core_unsubscribe.needs_connection = True
+
+    # System
+
+    def method_system_info(self):
+        return {
+            "version": "25.04.0-FAKE",
+            "hostname": "fake-truenas",
+            "model": "Fake CPU @ 3.00GHz",
+            "cores": 8,
+            "physmem": 64 * 1024 ** 3,
+            "ecc_memory": True,
+        }
+
+    def method_pool_query(self, filters=None, options=None):
+        return filter_list(self.pools, filters, options)
+
+    def method_system_general_config(self):
+        return {"ui_port": self.ui_port, "ui_httpsport": self.ui_port, "ui_certificate": self.ui_certificate}
+
+    def method_system_general_update(self, data):
+        if "ui_certificate" in data:
+            self.ui_certificate = next(cert for cert in self.certificates if cert["id"] == data["ui_certificate"])
+        return self.method_system_general_config()
+
+    def method_system_general_ui_restart(self, delay=3):
+        self.ui_restarts += 1
+
+    def method_auth_generate_token(self, *args):
+        return base64.urlsafe_b64encode(os.urandom(24)).decode()
+
+    def method_auth_login_with_token(self, token):
+        return True
+
+    def method_auth_login_with_api_key(self, key):
+        return True
+
+    def method_auth_login(self, username, password, otp_token=None):
+        return True
+
+    # Apps and catalog
+
+    def method_app_query(self, filters=None, options=None):
+        with self.lock:
+            apps = [dict(app) for app in self.apps]
+        return filter_list(apps, filters, options)
+
+    def method_app_config(self, name):
+        app = self.find_app(name)
+        return {"ix_context": {"app_metadata": {"version": app["version"]}}}
+
+    def method_app_upgrade(self, name, options=None):
+        app = self.find_app(name)
+
+        def upgrade():
+            app["version"] = "2.0.0"
+            app["human_version"] = "2.0.0_2.0.0"
+            app["upgrade_available"] = False
+            self.publish("app.query", "changed", name, app)
+            return dict(app)
+
+        return self.start_job("app.upgrade", [name], upgrade, self.jitter(self.upgrade_duration))
+
+    def method_app_upgrade_summary(self, name, options=None):
+        self.find_app(name)
+        return {"latest_version": "2.0.0", "upgrade_version": "2.0.0", "changelog": None}
+
+    def method_catalog_get_app_details(self, name, options=None):
+        return {"name": name, "versions": {"2.0.0": {"values": {"images": {"image": {"repository": f"example/{name}", "tag": "2.0.0"}}}}}}
+
+    def method_app_image_pull(self, options):
+        return self.start_job("app.image.pull", [options], lambda: None, self.jitter(self.pull_duration))
+
+    def method_catalog_sync(self):
+        return self.start_job("catalog.sync", [], lambda: None, self.sync_duration)
+
+    def find_app(self, name):
+        for app in self.apps:
+            if app["name"] == name:
+                return app
+        raise CallError(f"App {name!r} does not exist")
+
+    def jitter(self, duration):
+        return duration * self.random.uniform(0.5, 1.5)
+
+    # Configuration backup
+
+    def method_core_download(self, method, args, filename, *extra):
+        job_id = self.start_job(method, args, lambda: None, 0)
+        token = base64.urlsafe_b64encode(os.urandom(12)).decode()
+        self.downloads[token] = filename
+        return [job_id, f"/_download/{job_id}?auth_token={token}"]
+
+    def backup_payload(self):
+        """Return a config.save style tarball; it only changes when config_revision is bumped."""
+        if self._backup is None or self._backup[0] != self.config_revision:
+            database = random.Random(self.config_revision).randbytes(self.backup_size)
+            buffer = io.BytesIO()
+            with tarfile.open(fileobj=buffer, mode="w") as tar:
+                for name, data in (("freenas-v1.db", database), ("pwenc_secret", b"s" * 32),
+                                   ("root_authorized_keys", b"ssh-ed25519 AAAA fake\n")):
+                    info = tarfile.TarInfo(name)
+                    info.size = len(data)
+                    info.mtime = 1700000000 + self.config_revision
+                    tar.addfile(info, io.BytesIO(data))
+            self._backup = (self.config_revision, buffer.getvalue())
+        return self._backup[1]
+
+    # Init/shutdown scripts
+
+    def method_certificate_query(self, filters=None, options=None):
+        return filter_list(self.certificates, filters, options)
+
+    def method_certificate_create(self, data):
+        def create():
+            if any(cert["name"] == data["name"] for cert in self.certificates):
+                raise CallError(f"Certificate {data['name']!r} already exists")
+            cert = {"id": max([cert["id"] for cert in self.certificates], default=0) + 1, "name": data["name"],
+                    "certificate": data.get("certificate"), "privatekey": data.get("privatekey")}
+            self.certificates.append(cert)
+            return cert
+        return self.start_job("certificate.create", [data], create, 0)
+
+    def method_certificate_delete(self, ident, force=False):
+        def delete():
+            if self.ui_certificate and self.ui_certificate["id"] == ident:
+                raise CallError("Certificate is being used by the UI")
+            self.certificates = [cert for cert in self.certificates if cert["id"] != ident]
+            return True
+        return self.start_job("certificate.delete", [ident, force], delete, 0)
+
+    def method_initshutdownscript_query(self, filters=None, options=None):
+        return filter_list(self.init_scripts, filters, options)
+
+    def method_initshutdownscript_create(self, data):
+        script = {"id": len(self.init_scripts) + 1, "type": "COMMAND", "command": "", "script": None,
+                  "when": "POSTINIT", "enabled": True, "timeout": 10, "comment": ""}
+        script.update(data)
+        self.init_scripts.append(script)
+        return script
+
+    def method_initshutdownscript_update(self, ident, data):
+        for script in self.init_scripts:
+            if script["id"] == ident:
+                script.update(data)
+                return script
+        raise CallError(f"Init script {ident} does not exist")
+
+    def method_initshutdownscript_delete(self, ident):
+        self.init_scripts = [script for script in self.init_scripts if script["id"] != ident]
+        return True
+
+
+class Connection:
+    """One websocket connection speaking JSON-RPC 2.0."""
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.subscriptions = set()
+        self.send_lock = threading.Lock()
+
+    def send_frame(self, opcode, payload):
+        header = bytes([0x80 | opcode])
+        length = len(payload)
+        if length < 126:
+            header += bytes([length])
+        elif length < 1 << 16:
+            header += bytes([126]) + struct.pack("!H", length)
+        else:
+            header += bytes([127]) + struct.pack("!Q", length)
+        with self.send_lock:
+            self.handler.wfile.write(header + payload)
+            self.handler.wfile.flush()
+
+    def send_json(self, message):
+        try:
+            self.send_frame(0x1, json.dumps(message).encode())
+        except OSError:
+            pass
+
+    def read_frame(self):
+        rfile = self.handler.rfile
+        head = rfile.read(2)
+        if len(head) < 2:
+            return None, None, None
+        fin, opcode = head[0] & 0x80, head[0] & 0x0F
+        masked, length = head[1] & 0x80, head[1] & 0x7F
+        if length == 126:
+            length = struct.unpack("!H", rfile.read(2))[0]
+        elif length == 127:
+            length = struct.unpack("!Q", rfile.read(8))[0]
+        mask = rfile.read(4) if masked else b""
+        payload = rfile.read(length)
+        if masked:
+            payload = bytes(byte ^ mask[index % 4] for index, byte in enumerate(payload))
+        return fin, opcode, payload
+
+    def serve(self, middleware):
+        middleware.connections.add(self)
+        message = b""
+        try:
+            while True:
+                fin, opcode, payload = self.read_frame()
+                if opcode is None or opcode == 0x8:
+                    break
+                if opcode == 0x9:
+                    self.send_frame(0xA, payload)
+                    continue
+                if opcode in (0x0, 0x1, 0x2):
+                    message += payload
+                    if not fin:
+                        continue
+                    threading.Thread(target=self.dispatch, args=(middleware, message), daemon=True).start()
+                    message = b""
+        finally:
+            middleware.connections.discard(self)
+
+    def dispatch(self, middleware, raw):
+        request = json.loads(raw)
+        try:
+            result = middleware.call(self, request["method"], request.get("params") or [])
+            response = {"jsonrpc": "2.0", "id": request.get("id"), "result": result}
+        except (CallError, TypeError) as e:
+            response = {"jsonrpc": "2.0", "id": request.get("id"), "error": {
+                "code": -32001,
+                "message": "Method call error",
+                "data": {"error": 22, "errname": "EINVAL", "reason": str(e), "trace": None, "extra": []},
+            }}
+        if "id" in request:
+            self.send_json(response)
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    """Routes websocket upgrades, midclt shim calls and file downloads."""
+
+    def handle(self):
+        if isinstance(self.request, ssl.SSLSocket):
+            self.request.do_handshake()
+        request_line = self.rfile.readline().decode("latin-1").strip()
+        if not request_line:
+            return
+        method, target, _ = request_line.split(" ", 2)
+        headers = {}
+        while True:
+            line = self.rfile.readline().decode("latin-1").strip()
+            if not line:
+                break
+            key, value = line.split(":", 1)
+            headers[key.strip().lower()] = value.strip()
+        middleware = self.server.middleware
+        path = urlparse(target).path
+        if headers.get("upgrade", "").lower() == "websocket":
+            accept = base64.b64encode(hashlib.sha1((headers["sec-websocket-key"] + WEBSOCKET_GUID).encode()).digest()).decode()
+            self.wfile.write((
+                "HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                f"Sec-WebSocket-Accept: {accept}\r\n\r\n"
+            ).encode())
+            self.wfile.flush()
+            Connection(self).serve(middleware)
+        elif method == "POST" and path == "/_midclt":
+            body = json.loads(self.rfile.read(int(headers.get("content-length", 0))))
+            try:
+                result = middleware.call(None, body["method"], body.get("params", []))
+                if body.get("job"):
+                    result = middleware.wait_job(result)
+                self.send_response(200, json.dumps(result).encode())
+            except (CallError, TypeError) as e:
+                self.send_response(500, str(e).encode())
+        elif method == "GET" and path.startswith("/_download/"):
+            payload = middleware.backup_payload()
+            start = 0
+            if headers.get("range", "").startswith("bytes="):
+                start = int(headers["range"][6:].split("-", 1)[0])
+            with middleware.lock:
+                interrupt = middleware.interrupted_downloads > 0
+                middleware.interrupted_downloads -= interrupt
+            body = payload[start:]
+            if interrupt:
+                # Promise the full body but hang up half way through it.
+                self.send_response(206 if start else 200, body[:len(body) // 2], length=len(body),
+                                   headers={"Content-Range": f"bytes {start}-{len(payload) - 1}/{len(payload)}"} if start else None)
+            elif start:
+                self.send_response(206, body, headers={"Content-Range": f"bytes {start}-{len(payload) - 1}/{len(payload)}"})
+            else:
+                self.send_response(200, body)
+        else:
+            self.send_response(404, b"Not found")
+
+    def send_response(self, status, body, length=None, headers=None):
+        reason = {200: "OK", 206: "Partial Content", 404: "Not Found", 500: "Internal Server Error"}[status]
+        length = len(body) if length is None else length
+        extra = "".join(f"{key}: {value}\r\n" for key, value in (headers or {}).items())
+        self.wfile.write(f"HTTP/1.1 {status} {reason}\r\nContent-Length: {length}\r\n{extra}Connection: close\r\n\r\n".encode())
+        if body is not None:
+            self.wfile.write(body)
+        self.wfile.flush()
+
+
+class FakeMiddlewareServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, middleware, address=("127.0.0.1", 0), ssl_context=None):
+        super().__init__(address, RequestHandler)
+        self.middleware = middleware
+        self.ssl_context = ssl_context
+
+    def get_request(self):
+        sock, address = super().get_request()
+        if self.ssl_context is not None:
+            sock = self.ssl_context.wrap_socket(sock, server_side=True, do_handshake_on_connect=False)
+        return sock, address
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a fake TrueNAS middleware for offline benchmarks.")
+    parser.add_argument("--port", type=int, default=6000, help="Port for plain websocket/HTTP connections")
+    parser.add_argument("--tls-port", type=int, default=0, help="Optional port for TLS connections (needs --cert and --key)")
+    parser.add_argument("--cert", help="TLS certificate file")
+    parser.add_argument("--key", help="TLS private key file")
+    parser.add_argument("--apps", type=int, default=50, help="Number of installed apps")
+    parser.add_argument("--upgradable-ratio", type=float, default=0.5, help="Fraction of apps with an upgrade available")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every call")
+    parser.add_argument("--upgrade-duration", type=float, default=0.5, help="Average seconds per app.upgrade job")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="Fraction of jobs that fail")
+    parser.add_argument("--backup-size", type=int, default=1024 * 1024, help="Size in bytes of the config database in backups")
+    args = parser.parse_args()
+    middleware = FakeMiddleware(apps=args.apps, upgradable_ratio=args.upgradable_ratio, latency=args.latency,
+                                upgrade_duration=args.upgrade_duration, failure_rate=args.failure_rate,
+                                backup_size=args.backup_size, ui_port=args.tls_port or args.port)
+    FakeMiddlewareServer(middleware, ("127.0.0.1", args.port)).start()
+    print(f"Fake middleware listening on ws://127.0.0.1:{args.port}/api/current")
+    if args.tls_port:
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(args.cert, args.key)
+        FakeMiddlewareServer(middleware, ("127.0.0.1", args.tls_port), context).start()
+        print(f"Fake middleware listening on wss://127.0.0.1:{args.tls_port}/api/current")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+"""
+Offline benchmark suite for the TrueNAS scripts.
+
+Starts the fake middleware for each app count, runs update_apps.py (over midclt and
+the websocket client), configuration_backup_websocket.py, persistent_crontab.py and
+generate_forum_signature.py end to end against it, and reports wall-clock times. Results can be saved as JSON
+and compared against a baseline to fail CI on regressions.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import ssl
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from fake_middleware import FakeMiddleware, FakeMiddlewareServer
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+SHIM_DIR = os.path.join(BENCHMARK_DIR, "bin")
+
+
+def has_api_client() -> bool:
+    try:
+        import truenas_api_client  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def create_tls_context(workdir: str):
+    """Create a self-signed certificate for the wss:// listener using the openssl CLI."""
+    cert = os.path.join(workdir, "cert.pem")
+    key = os.path.join(workdir, "key.pem")
+    try:
+        subprocess.run(
+            ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+             "-subj", "/CN=localhost", "-keyout", key, "-out", cert],
+            check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(cert, key)
+    return context
+
+
+def setup_update_apps(workdir: str, transport: str) -> list:
+    script_dir = os.path.join(workdir, "update-apps")
+    os.makedirs(script_dir, exist_ok=True)
+    shutil.copy(os.path.join(REPO_DIR, "update-apps", "update_apps.py"), script_dir)
+    config = {
+        "hostname": "benchmark",
+        "discord": {"enabled": False, "webhook_url": ""},
+        "slack": {"enabled": False, "webhook_url": ""},
+        "exclude": {"apps": []},
+        "upgrade": {"max_workers": 4, "timeout": 300},
+        "middleware": {"transport": transport},
+        "debug": {"enabled": False, "dry_run": False},
+    }
+    with open(os.path.join(script_dir, "update_apps.json"), "w") as f:
+        json.dump(config, f)
+    return [sys.executable, os.path.join(script_dir, "update_apps.py")]
+
+
+def setup_configuration_backup(workdir: str, transport: str) -> list:
+    output_dir = os.path.join(workdir, "backups")
+    os.makedirs(output_dir, exist_ok=True)
+    return [sys.executable, os.path.join(REPO_DIR, "configuration-backup", "configuration_backup_websocket.py"),
+            "--output-dir", output_dir]
+
+
+def setup_persistent_crontab(workdir: str, transport: str) -> list:
+    return [sys.executable, os.path.join(REPO_DIR, "persistent-crontab", "persistent_crontab.py"),
+            "--crontab-backup-file", os.path.join(workdir, "crontab.bak"), "--no-confirm"]
+
+
+def setup_forum_signature(workdir: str, transport: str) -> list:
+    return [sys.executable, os.path.join(REPO_DIR, "generate-forum-signature", "generate_forum_signature.py"),
+            "--cache-file", os.path.join(workdir, "baseboard.json")]
+
+
+# (name, transport, setup function, needs truenas_api_client, needs TLS)
+BENCHMARKS = [
+    ("update_apps", "midclt", setup_update_apps, False, False),
+    ("update_apps", "websocket", setup_update_apps, True, False),
+    ("configuration_backup_websocket", "websocket", setup_configuration_backup, True, True),
+    ("persistent_crontab", "websocket", setup_persistent_crontab, True, False),
+    ("generate_forum_signature", "websocket", setup_forum_signature, True, False),
+]
+
+
+def run_once(args, app_count: int, name: str, transport: str, setup, tls_context) -> float:
+    """Run one script against a fresh fake middleware and return its wall-clock time."""
+    middleware = FakeMiddleware(apps=app_count, latency=args.latency, upgrade_duration=args.upgrade_duration,
+                                pull_duration=args.upgrade_duration / 2, sync_duration=args.sync_duration,
+                                failure_rate=args.failure_rate, backup_size=args.backup_size)
+    server = FakeMiddlewareServer(middleware).start()
+    tls_server = None
+    if tls_context is not None:
+        tls_server = FakeMiddlewareServer(middleware, ssl_context=tls_context).start()
+        middleware.ui_port = tls_server.port
+    # Persistent crontab paths must live under /mnt, /home or /root.
+    workdir = tempfile.mkdtemp(prefix="truenas-bench-", dir=os.path.expanduser("~"))
+    try:
+        command = setup(workdir, transport)
+        env = dict(os.environ)
+        env["PATH"] = SHIM_DIR + os.pathsep + env.get("PATH", "")
+        env["FAKE_MIDDLEWARE_URL"] = f"http://127.0.0.1:{server.port}"
+        env["TRUENAS_API_URI"] = f"ws://127.0.0.1:{server.port}/api/current"
+        start = time.perf_counter()
+        result = subprocess.run(command, env=env, cwd=workdir, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        elapsed = time.perf_counter() - start
+        if result.returncode != 0:
+            raise RuntimeError(f"{name} ({transport}) exited with {result.returncode}:\n{result.stdout[-2000:]}")
+        return elapsed
+    finally:
+        server.shutdown()
+        server.server_close()
+        if tls_server is not None:
+            tls_server.shutdown()
+            tls_server.server_close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def compare_to_baseline(results: list, baseline_path: str, max_regression: float) -> bool:
+    """Print the change against a baseline results file. Returns False if any benchmark regressed too far."""
+    with open(baseline_path, "r") as f:
+        baseline = {(r["script"], r["transport"], r["apps"]): r for r in json.load(f)["results"]}
+    ok = True
+    print(f"\nComparison with {baseline_path} (max regression {max_regression:.0%}):")
+    for result in results:
+        previous = baseline.get((result["script"], result["transport"], result["apps"]))
+        if previous is None or "median" not in previous or "median" not in result:
+            continue
+        change = result["median"] / previous["median"] - 1
+        status = "ok"
+        if change > max_regression:
+            status = "REGRESSION"
+            ok = False
+        print(f"  {result['script']:<32} {result['transport']:<10} {result['apps']:>5} apps  "
+              f"{previous['median']:8.3f}s -> {result['median']:8.3f}s  {change:+7.1%}  {status}")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the TrueNAS scripts against a fake middleware.")
+    parser.add_argument("--apps", default="1,50,500", help="Comma-separated app counts (default: 1,50,500)")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per benchmark (default: 3)")
+    parser.add_argument("--latency", type=float, default=0.002, help="Seconds added to every middleware call")
+    parser.add_argument("--upgrade-duration", type=float, default=0.05, help="Average seconds per app.upgrade job")
+    parser.add_argument("--sync-duration", type=float, default=0.2, help="Seconds per catalog.sync job")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="Fraction of jobs that fail")
+    parser.add_argument("--backup-size", type=int, default=4 * 1024 * 1024, help="Config backup size in bytes")
+    parser.add_argument("--only", help="Comma-separated script names to run")
+    parser.add_argument("--output", help="Write results as JSON to this file")
+    parser.add_argument("--baseline", help="Compare against a previous --output file")
+    parser.add_argument("--max-regression", type=float, default=0.25,
+                        help="Allowed slowdown against the baseline before failing (default: 0.25)")
+    args = parser.parse_args()
+
+    api_client = has_api_client()
+    tls_dir = tempfile.mkdtemp(prefix="truenas-bench-tls-")
+    tls_context = create_tls_context(tls_dir)
+    only = set(args.only.split(",")) if args.only else None
+    results = []
+    print(f"{'script':<32} {'transport':<10} {'apps':>5}  {'median':>8}  {'min':>8}  {'max':>8}")
+    try:
+        for app_count in (int(count) for count in args.apps.split(",")):
+            for name, transport, setup, needs_client, needs_tls in BENCHMARKS:
+                if only and name not in only:
+                    continue
+                result = {"script": name, "transport": transport, "apps": app_count}
+                if needs_client and not api_client:
+                    result["skipped"] = "truenas_api_client is not installed"
+                elif needs_tls and tls_context is None:
+                    result["skipped"] = "openssl is not available to create a TLS certificate"
+                else:
+                    timings = [run_once(args, app_count, name, transport, setup, tls_context if needs_tls else None)
+                               for _ in range(args.repeat)]
+                    result.update(median=round(statistics.median(timings), 4), min=round(min(timings), 4),
+                                  max=round(max(timings), 4), runs=[round(t, 4) for t in timings])
+                results.append(result)
+                if "skipped" in result:
+                    print(f"{name:<32} {transport:<10} {app_count:>5}  skipped: {result['skipped']}")
+                else:
+                    print(f"{name:<32} {transport:<10} {app_count:>5}  {result['median']:8.3f}s {result['min']:8.3f}s {result['max']:8.3f}s")
+    finally:
+        shutil.rmtree(tls_dir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"parameters": vars(args), "results": results}, f, indent=4)
+    if args.baseline and not compare_to_baseline(results, args.baseline, args.max_regression):
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -7,6 +7,10 @@ import sys
 import datetime
 import re
 
+# Download chunk size and (connect, read) timeouts for the backup tarball.
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+DOWNLOAD_TIMEOUT = (10, 300)
+
 """
 Automated TrueNAS configuration backup utility.
 Handles config backup creation via midclt API calls and file download.
@@ -131,20 +135,23 @@ def main():
     os.makedirs(output_dir, exist_ok=True)
     
     print("Downloading file ...")
+    output_file = os.path.join(output_dir, backup_filename)
+    part_file = f"{output_file}.part"
     try:
-        response = requests.get(download_url, verify=False, stream=True)
-        response.raise_for_status()
-        
-        filename = backup_filename
-        output_file = os.path.join(output_dir, filename)
-        
-        with open(output_file, "wb") as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                if chunk:
+        with requests.get(download_url, verify=False, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+            response.raise_for_status()
+            with open(part_file, "wb") as f:
+                for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
                     f.write(chunk)
+                f.flush()
+                os.fsync(f.fileno())
+        # Only a complete download replaces the final file name
+        os.replace(part_file, output_file)
         print(f"Download successful. File saved to: {output_file}")
     except requests.RequestException as e:
         print("Error downloading file:", e)
+        if os.path.exists(part_file):
+            os.remove(part_file)
         sys.exit(1)
 
 if __name__ == "__main__":
@@ -1,6 +1,20 @@
 import argparse
+import gzip
+import hashlib
+import json
 import os
+import re
+import shutil
+import socket
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from urllib.parse import urlparse
 from truenas_api_client import Client
 import urllib3
 import requests
@@ -12,22 +26,712 @@ def generate_backup_filename(hostname, truenas_version, timestamp):
     """
     return f"{hostname}-{truenas_version}-{timestamp}.tar"
 
-def download_backup_file(download_url, output_file):
+_log_context = threading.local()
+
+def log(message):
+    """
+    Print a message, prefixed with the host being collected when running in collector mode.
+    """
+    prefix = getattr(_log_context, "prefix", "")
+    print(f"{prefix}{message}", flush=True)
+
+# Index of backups kept in the output directory.
+INDEX_FILENAME = "backups.sqlite3"
+
+# Fingerprints of the files packed by config.save, from the last backup taken with --if-changed.
+STATE_FILENAME = "backup_state.json"
+
+# Files config.save packs with secretseed and root_authorized_keys enabled.
+CONFIG_FILES = ("/data/freenas-v1.db", "/data/pwenc_secret", "/root/.ssh/authorized_keys")
+
+# Matches <hostname>-<version>-<timestamp>.tar, with an optional .json store reference suffix.
+BACKUP_FILENAME_PATTERN = re.compile(r"^(?P<hostname>.+?)-(?P<version>unknown|\d+\.\d+.*)-(?P<timestamp>\d{14})\.tar(?:\.json)?$")
+
+# Backups up to this size are hashed and compressed in memory before touching the store.
+SPOOL_MAX_SIZE = 64 * 1024 * 1024
+
+# Download chunk size and (connect, read) timeouts. The read timeout applies
+# between chunks, so large tarballs are not cut off part way through.
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+DOWNLOAD_TIMEOUT = (10, 300)
+DOWNLOAD_ATTEMPTS = 3
+DOWNLOAD_RETRY_DELAY = 2
+
+# Members a config.save tarball must contain to be restorable.
+REQUIRED_MEMBERS = ("freenas-v1.db", "pwenc_secret")
+
+TAR_BLOCK_SIZE = 512
+TAR_MEMBER_TYPES = {"0": "file", "1": "hardlink", "2": "symlink", "5": "directory"}
+
+class TarStreamVerifier:
+    """
+    Parse tar member headers as backup bytes stream in, so the archive can
+    be checked without reading it again. File contents are skipped rather
+    than buffered. GNU long name ('L') and pax ('x') headers are applied to
+    the member that follows them.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.members = []
+        self.buffer = b""
+        self.skip = 0
+        self.capture = None
+        self.pending = {}
+        self.ended = False
+        self.error = None
+
+    def feed(self, chunk):
+        data = memoryview(chunk)
+        while data and not self.ended and not self.error:
+            if self.skip:
+                skipped = min(self.skip, len(data))
+                self.skip -= skipped
+                data = data[skipped:]
+                continue
+            needed = padded_tar_size(self.capture[1]) if self.capture else TAR_BLOCK_SIZE
+            taken = min(needed - len(self.buffer), len(data))
+            self.buffer += bytes(data[:taken])
+            data = data[taken:]
+            if len(self.buffer) < needed:
+                break
+            block, self.buffer = self.buffer, b""
+            try:
+                if self.capture:
+                    self.parse_extended_header(block)
+                else:
+                    self.parse_header(block)
+            except (ValueError, IndexError) as e:
+                # Not a tar at all (e.g. an HTML error page) or a corrupted header
+                self.capture = None
+                self.error = f"malformed tar header after {len(self.members)} member(s): {e}"
+
+    def parse_header(self, block):
+        if not block.strip(b"\0"):
+            self.ended = True
+            return
+        checksum = int(block[148:156].strip(b"\0 ") or b"0", 8)
+        if checksum != sum(block[:148]) + 8 * ord(" ") + sum(block[156:]):
+            self.error = f"bad header checksum after {len(self.members)} member(s)"
+            return
+        size_field = block[124:136]
+        if size_field[0] & 0x80:
+            size = int.from_bytes(size_field[1:], "big")
+        else:
+            size = int(size_field.strip(b"\0 ") or b"0", 8)
+        typeflag = block[156:157].decode("ascii", "replace").strip("\0") or "0"
+        if typeflag in ("L", "K", "x", "g"):
+            self.capture = (typeflag, size)
+            return
+        name = block[:100].split(b"\0", 1)[0].decode("utf-8", "replace")
+        prefix = block[345:500].split(b"\0", 1)[0].decode("utf-8", "replace")
+        if block[257:262] == b"ustar" and prefix:
+            name = f"{prefix}/{name}"
+        self.members.append({
+            "name": self.pending.get("path", name).rstrip("/"),
+            "size": self.pending.get("size", size),
+            "type": TAR_MEMBER_TYPES.get(typeflag, "other"),
+        })
+        self.pending = {}
+        self.skip = padded_tar_size(self.members[-1]["size"])
+
+    def parse_extended_header(self, block):
+        typeflag, size = self.capture
+        self.capture = None
+        content = block[:size]
+        if typeflag == "L":
+            self.pending["path"] = content.split(b"\0", 1)[0].decode("utf-8", "replace")
+        elif typeflag == "x":
+            # Records look like "<length> <key>=<value>\n".
+            while content:
+                length = int(content.split(b" ", 1)[0])
+                if length <= 0:
+                    raise ValueError(f"invalid pax record length {length}")
+                key, _, value = content[:length].split(b" ", 1)[1].rstrip(b"\n").partition(b"=")
+                if key == b"path":
+                    self.pending["path"] = value.decode("utf-8", "replace")
+                elif key == b"size":
+                    self.pending["size"] = int(value)
+                content = content[length:]
+
+    def problems(self):
+        """
+        Return the reasons the archive is not a complete config backup.
+        """
+        if self.error:
+            return [self.error]
+        problems = []
+        if not self.ended:
+            problems.append("archive is truncated (no end-of-archive marker)")
+        names = {os.path.basename(member["name"]) for member in self.members if member["type"] == "file"}
+        problems.extend(f"missing {member}" for member in REQUIRED_MEMBERS if member not in names)
+        return problems
+
+def padded_tar_size(size):
     """
-    Download the backup file from the provided URL and save it to the 
-    specified output file.
+    Return the size rounded up to a whole number of tar blocks.
     """
+    return -(-size // TAR_BLOCK_SIZE) * TAR_BLOCK_SIZE
+
+def fsync_replace(tmp_file, final_file):
+    """
+    Atomically move a fully written temp file into place and make the rename
+    durable by syncing the containing directory.
+    """
+    os.replace(tmp_file, final_file)
+    dir_fd = os.open(os.path.dirname(os.path.abspath(final_file)), os.O_RDONLY)
     try:
-        response = requests.get(download_url, verify=False, stream=True, timeout=10)
-        response.raise_for_status()
-        with open(output_file, "wb") as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                if chunk:
-                    f.write(chunk)
-    except requests.exceptions.Timeout:
-        print("Timeout occurred while downloading the backup file.")
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+class FileBackupWriter:
+    """
+    Write a downloaded backup to a .part file in the output directory and
+    rename it into place once the download completes.
+    """
+    def __init__(self, output_dir, backup_filename):
+        self.output_file = os.path.join(output_dir, backup_filename)
+        self.part_file = f"{self.output_file}.part"
+        self.file = open(self.part_file, "wb")
+        self.object_path = None
+        self.reset()
+
+    def reset(self):
+        self.file.seek(0)
+        self.file.truncate()
+        self.hasher = hashlib.sha256()
+        self.verifier = TarStreamVerifier()
+        self.size = 0
+
+    def write(self, chunk):
+        self.hasher.update(chunk)
+        self.verifier.feed(chunk)
+        self.size += len(chunk)
+        self.file.write(chunk)
+
+    def close(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        fsync_replace(self.part_file, self.output_file)
+        self.digest = self.hasher.hexdigest()
+        return self.output_file
+
+    def abort(self):
+        self.file.close()
+        os.remove(self.part_file)
+
+class StoreBackupWriter:
+    """
+    Hash and compress a downloaded backup as it streams in, then store the
+    payload once under objects/ keyed by its SHA-256 digest. Each backup is
+    recorded as a small JSON reference, so an unchanged configuration costs
+    one reference file instead of another full tarball.
+    """
+    def __init__(self, store_dir, backup_filename, metadata):
+        self.store_dir = store_dir
+        self.backup_filename = backup_filename
+        self.metadata = metadata
+        self.spool = None
+        self.reset()
+
+    def reset(self):
+        if self.spool is not None:
+            self.spool.close()
+        self.hasher = hashlib.sha256()
+        self.verifier = TarStreamVerifier()
+        self.size = 0
+        self.spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE, dir=self.store_dir)
+        self.compressor = gzip.GzipFile(fileobj=self.spool, mode="wb", mtime=0)
+
+    def write(self, chunk):
+        self.hasher.update(chunk)
+        self.verifier.feed(chunk)
+        self.size += len(chunk)
+        self.compressor.write(chunk)
+
+    def close(self):
+        self.compressor.close()
+        digest = self.digest = self.hasher.hexdigest()
+        object_path = self.object_path = store_object_path(digest)
+        object_file = os.path.join(self.store_dir, object_path)
+        if os.path.exists(object_file):
+            log(f"Backup unchanged, reusing stored object {object_path}")
+        else:
+            os.makedirs(os.path.dirname(object_file), exist_ok=True)
+            self.spool.seek(0)
+            tmp_file = f"{object_file}.tmp"
+            with open(tmp_file, "wb") as f:
+                shutil.copyfileobj(self.spool, f)
+                f.flush()
+                os.fsync(f.fileno())
+            fsync_replace(tmp_file, object_file)
+            log(f"Stored new backup object {object_path}")
+        self.spool.close()
+        reference = dict(self.metadata, digest=f"sha256:{digest}", object=object_path,
+                         size=self.size, compressed_size=os.path.getsize(object_file))
+        reference_file = os.path.join(self.store_dir, f"{self.backup_filename}.json")
+        with open(f"{reference_file}.tmp", "w") as f:
+            json.dump(reference, f, indent=4)
+            f.flush()
+            os.fsync(f.fileno())
+        fsync_replace(f"{reference_file}.tmp", reference_file)
+        return reference_file
+
+    def abort(self):
+        self.compressor.close()
+        self.spool.close()
+
+def store_object_path(digest):
+    """
+    Return the path of a stored object relative to the store directory.
+    """
+    return os.path.join("objects", digest[:2], f"{digest}.tar.gz")
+
+def extract_store_backup(reference_file, output_file):
+    """
+    Write the original tarball referenced by a store entry to output_file.
+    """
+    with open(reference_file, "r") as f:
+        reference = json.load(f)
+    store_dir = os.path.dirname(os.path.abspath(reference_file))
+    with gzip.open(os.path.join(store_dir, reference["object"]), "rb") as src, open(output_file, "wb") as dst:
+        shutil.copyfileobj(src, dst)
+    print(f"Extracted {os.path.basename(reference_file)} to {output_file}")
+
+def open_index(output_dir):
+    """
+    Open (creating if needed) the SQLite index of backups in the output directory.
+    """
+    index = sqlite3.connect(os.path.join(output_dir, INDEX_FILENAME))
+    index.row_factory = sqlite3.Row
+    index.executescript("""
+        CREATE TABLE IF NOT EXISTS backups (
+            id INTEGER PRIMARY KEY,
+            filename TEXT NOT NULL UNIQUE,
+            hostname TEXT NOT NULL,
+            version TEXT NOT NULL,
+            timestamp TEXT NOT NULL,
+            size INTEGER,
+            checksum TEXT,
+            object TEXT
+        );
+        CREATE INDEX IF NOT EXISTS backups_hostname_timestamp ON backups (hostname, timestamp);
+        CREATE INDEX IF NOT EXISTS backups_version_timestamp ON backups (version, timestamp);
+    """)
+    return index
+
+def record_backup(index, filename, hostname, truenas_version, timestamp, size, digest, object_path=None):
+    """
+    Add a backup to the index.
+    """
+    with index:
+        index.execute(
+            "INSERT OR REPLACE INTO backups (filename, hostname, version, timestamp, size, checksum, object) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (filename, hostname, truenas_version, timestamp, size, f"sha256:{digest}" if digest else None, object_path),
+        )
+
+def query_backups(index, hostname=None, truenas_version=None):
+    """
+    Return indexed backups, newest first, optionally filtered by hostname and version.
+    """
+    conditions, params = [], []
+    if hostname:
+        conditions.append("hostname = ?")
+        params.append(hostname)
+    if truenas_version:
+        conditions.append("version = ?")
+        params.append(truenas_version)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    return index.execute(f"SELECT * FROM backups {where} ORDER BY timestamp DESC", params).fetchall()
+
+def list_backups(index, hostname=None, truenas_version=None):
+    """
+    Print indexed backups as a table.
+    """
+    rows = query_backups(index, hostname, truenas_version)
+    print("Timestamp      | Hostname | Version | Size | Checksum | File")
+    print("-" * 80)
+    for row in rows:
+        print(f"{row['timestamp']} | {row['hostname']} | {row['version']} | {row['size']} | "
+              f"{(row['checksum'] or '')[:19]} | {row['filename']}")
+    print(f"{len(rows)} backup(s)")
+
+def find_latest_backup(index, output_dir, hostname=None, truenas_version=None):
+    """
+    Print the path of the newest backup matching the filters, for restores.
+    """
+    rows = query_backups(index, hostname, truenas_version)
+    if not rows:
+        print("No matching backup found")
+        return False
+    print(os.path.join(output_dir, rows[0]["filename"]))
+    return True
+
+def reindex_backups(index, output_dir):
+    """
+    Rebuild the index from the backups found in the output directory.
+    """
+    count = 0
+    for filename in sorted(os.listdir(output_dir)):
+        match = BACKUP_FILENAME_PATTERN.match(filename)
+        if not match:
+            continue
+        path = os.path.join(output_dir, filename)
+        if filename.endswith(".json"):
+            with open(path, "r") as f:
+                reference = json.load(f)
+            record_backup(index, filename, reference["hostname"], reference["version"], reference["timestamp"],
+                          reference["size"], reference["digest"].split(":", 1)[-1], reference["object"])
+        else:
+            hasher = hashlib.sha256()
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    hasher.update(chunk)
+            record_backup(index, filename, match["hostname"], match["version"], match["timestamp"],
+                          os.path.getsize(path), hasher.hexdigest())
+        count += 1
+    print(f"Indexed {count} backup(s)")
+
+def select_retained(rows, keep_last, keep_daily, keep_weekly, keep_monthly):
+    """
+    Return the ids of the backups kept by the retention policy. Rows must be
+    newest first; the newest backup of each day, ISO week and month is kept
+    for the most recent keep_daily days, keep_weekly weeks and keep_monthly months.
+    """
+    keep = {row["id"] for row in rows[:keep_last]}
+    periods = [
+        (keep_daily, lambda ts: ts.strftime("%Y-%m-%d")),
+        (keep_weekly, lambda ts: "%d-W%02d" % ts.isocalendar()[:2]),
+        (keep_monthly, lambda ts: ts.strftime("%Y-%m")),
+    ]
+    for limit, period_of in periods:
+        seen = set()
+        for row in rows:
+            if len(seen) >= limit:
+                break
+            period = period_of(datetime.strptime(row["timestamp"], "%Y%m%d%H%M%S"))
+            if period not in seen:
+                seen.add(period)
+                keep.add(row["id"])
+    return keep
+
+def apply_retention(index, output_dir, keep_last=0, keep_daily=0, keep_weekly=0, keep_monthly=0):
+    """
+    Delete backups not kept by the retention policy, per hostname, in one pass
+    over the index. Store objects no longer referenced by any backup are removed too.
+    """
+    removed = 0
+    hostnames = [row["hostname"] for row in index.execute("SELECT DISTINCT hostname FROM backups")]
+    for hostname in hostnames:
+        rows = query_backups(index, hostname)
+        keep = select_retained(rows, keep_last, keep_daily, keep_weekly, keep_monthly)
+        for row in rows:
+            if row["id"] in keep:
+                continue
+            for path in backup_files(output_dir, row["filename"]):
+                if os.path.exists(path):
+                    os.remove(path)
+            with index:
+                index.execute("DELETE FROM backups WHERE id = ?", (row["id"],))
+            if row["object"] and not index.execute("SELECT 1 FROM backups WHERE object = ?", (row["object"],)).fetchone():
+                object_file = os.path.join(output_dir, row["object"])
+                if os.path.exists(object_file):
+                    os.remove(object_file)
+            removed += 1
+    log(f"Retention removed {removed} backup(s)")
+
+def backup_files(output_dir, filename):
+    """
+    Return the files on disk that belong to an indexed backup.
+    """
+    return [os.path.join(output_dir, filename), manifest_path(output_dir, filename)]
+
+def manifest_path(output_dir, filename):
+    """
+    Return the manifest path for a backup file or store reference.
+    """
+    return os.path.join(output_dir, f"{filename.removesuffix('.json')}.manifest.json")
+
+def write_manifest(output_dir, filename, writer):
+    """
+    Write the members, size and digest seen while the backup streamed in.
+    """
+    manifest = {
+        "backup": filename,
+        "digest": f"sha256:{writer.digest}",
+        "size": writer.size,
+        "members": writer.verifier.members,
+    }
+    path = manifest_path(output_dir, filename)
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(manifest, f, indent=4)
+        f.flush()
+        os.fsync(f.fileno())
+    fsync_replace(f"{path}.tmp", path)
+
+def verify_backup(output_dir, row):
+    """
+    Re-read an indexed backup and compare it with its manifest. Returns a
+    list of problems, empty if the backup is intact.
+    """
+    try:
+        with open(manifest_path(output_dir, row["filename"]), "r") as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        return ["no manifest"]
+    hasher = hashlib.sha256()
+    verifier = TarStreamVerifier()
+    size = 0
+    try:
+        if row["object"]:
+            source = gzip.open(os.path.join(output_dir, row["object"]), "rb")
+        else:
+            source = open(os.path.join(output_dir, row["filename"]), "rb")
+        with source:
+            for chunk in iter(lambda: source.read(DOWNLOAD_CHUNK_SIZE), b""):
+                hasher.update(chunk)
+                verifier.feed(chunk)
+                size += len(chunk)
+    except (OSError, EOFError, zlib.error) as e:
+        return [f"unreadable: {e}"]
+    problems = verifier.problems()
+    if size != manifest["size"]:
+        problems.append(f"size {size} does not match manifest size {manifest['size']}")
+    if f"sha256:{hasher.hexdigest()}" != manifest["digest"]:
+        problems.append("digest does not match manifest")
+    if verifier.members != manifest["members"]:
+        problems.append("members do not match manifest")
+    return problems
+
+def verify_backups(index, output_dir, hostname=None, truenas_version=None):
+    """
+    Check every indexed backup against its manifest. Returns True if all pass.
+    """
+    failed = 0
+    rows = query_backups(index, hostname, truenas_version)
+    for row in rows:
+        problems = verify_backup(output_dir, row)
+        if problems:
+            failed += 1
+            print(f"FAILED {row['filename']}: {', '.join(problems)}")
+        else:
+            print(f"OK     {row['filename']}")
+    print(f"{len(rows) - failed}/{len(rows)} backup(s) verified")
+    return failed == 0
+
+def fingerprint_config_files(previous):
+    """
+    Fingerprint the configuration files by size and SHA-256. A file whose
+    mtime and size match the previous fingerprint is not hashed again.
+    """
+    fingerprint = {}
+    for path in CONFIG_FILES:
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            fingerprint[path] = None
+            continue
+        old = previous.get(path)
+        if old and old["mtime_ns"] == stat.st_mtime_ns and old["size"] == stat.st_size:
+            fingerprint[path] = old
+            continue
+        hasher = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b""):
+                hasher.update(chunk)
+        fingerprint[path] = {"mtime_ns": stat.st_mtime_ns, "size": stat.st_size, "sha256": hasher.hexdigest()}
+    return fingerprint
+
+def config_changed(previous, current):
+    """
+    Return True if the content of any configuration file differs between two fingerprints.
+    """
+    def content(fingerprint):
+        return {path: entry and entry["sha256"] for path, entry in fingerprint.items()}
+    return not previous or content(previous) != content(current)
+
+def load_state(output_dir):
+    """
+    Load the config file fingerprints saved by the last --if-changed backup.
+    """
+    try:
+        with open(os.path.join(output_dir, STATE_FILENAME), "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+def save_state(output_dir, fingerprint):
+    """
+    Atomically save the config file fingerprints.
+    """
+    path = os.path.join(output_dir, STATE_FILENAME)
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(fingerprint, f, indent=4)
+        f.flush()
+        os.fsync(f.fileno())
+    fsync_replace(f"{path}.tmp", path)
+
+def download_backup_file(session, request_download_url, writer, verify=False, attempts=DOWNLOAD_ATTEMPTS):
+    """
+    Stream the backup file into the backup writer. An interrupted transfer is
+    resumed with a Range request where the server allows it; otherwise the
+    writer is reset and a fresh download URL is requested. Returns the saved
+    path, or None if every attempt failed.
+    """
+    download_url = request_download_url()
+    for attempt in range(1, attempts + 1):
+        if attempt > 1:
+            time.sleep(DOWNLOAD_RETRY_DELAY)
+        headers = {"Range": f"bytes={writer.size}-"} if writer.size else {}
+        try:
+            with session.get(download_url, headers=headers, verify=verify, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+                response.raise_for_status()
+                if writer.size and response.status_code != 206:
+                    # The server ignored the Range header and is sending the whole file again.
+                    writer.reset()
+                expected = int(response.headers["Content-Length"]) + writer.size if "Content-Length" in response.headers else None
+                for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    writer.write(chunk)
+            if expected is not None and writer.size != expected:
+                raise requests.exceptions.ContentDecodingError(f"received {writer.size} of {expected} bytes")
+            problems = writer.verifier.problems()
+            if problems:
+                # The transfer finished, so fetching the same payload again will not help.
+                log(f"Backup failed verification: {', '.join(problems)}")
+                break
+            return writer.close()
+        except requests.exceptions.HTTPError as e:
+            log(f"Download attempt {attempt}/{attempts} failed: {e}")
+            if attempt < attempts:
+                # The download token may be spent or expired, so start over with a new one.
+                writer.reset()
+                download_url = request_download_url()
+        except requests.exceptions.RequestException as e:
+            log(f"Download attempt {attempt}/{attempts} interrupted after {writer.size} bytes: {e}")
+    writer.abort()
+    return None
+
+def take_backup(c, session, download_base, output_dir, index, hostname, truenas_version, store, retention, verify=False):
+    """
+    Download, verify and index one config backup over an open middleware
+    session. Returns the indexed filename, or None if the download failed.
+    """
+    timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
+    backup_filename = generate_backup_filename(hostname, truenas_version, timestamp)
+
+    def request_download_url():
+        config_result = c.call("core.download", "config.save", [{"secretseed": True, "root_authorized_keys": True}], backup_filename)
+        return f"{download_base}{config_result[1]}"
+
+    if store:
+        writer = StoreBackupWriter(output_dir, backup_filename, {
+            "hostname": hostname, "version": truenas_version, "timestamp": timestamp,
+        })
+    else:
+        writer = FileBackupWriter(output_dir, backup_filename)
+    output_file = download_backup_file(session, request_download_url, writer, verify)
+    if output_file is None:
+        log("Download failed.")
+        return None
+    log(f"Download successful. File saved to: {output_file}")
+    filename = os.path.basename(output_file)
+    write_manifest(output_dir, filename, writer)
+    record_backup(index, filename, hostname, truenas_version, timestamp, writer.size, writer.digest, writer.object_path)
+    if any(retention):
+        apply_retention(index, output_dir, *retention)
+    return filename
+
+def load_collector_hosts(hosts_path):
+    """
+    Load the collector host list, reading API keys and passwords from files where given.
+    """
+    with open(hosts_path, "r") as f:
+        inventory = json.load(f)
+    for host in inventory.get("hosts", []):
+        if not host.get("name") or not host.get("uri"):
+            raise ValueError(f"Collector host entries need a name and uri: {host}")
+        for key in ("api_key", "password"):
+            if host.get(f"{key}_file"):
+                with open(host[f"{key}_file"], "r") as f:
+                    host[key] = f.read().strip()
+        if not host.get("api_key") and not (host.get("username") and host.get("password")):
+            raise ValueError(f"Collector host {host['name']} needs an api_key or a username and password")
+    return inventory
+
+def collect_host(host, output_dir, store, retention):
+    """
+    Log in to a remote host and take a backup into its own directory.
+    Returns a summary entry for the collector report.
+    """
+    name = host["name"]
+    _log_context.prefix = f"[{name}] "
+    host_dir = os.path.join(output_dir, name)
+    os.makedirs(host_dir, exist_ok=True)
+    result = {"host": name, "status": "failed", "file": None, "size": None, "digest": None, "error": None}
+    start = time.monotonic()
+    verify = host.get("verify_ssl", True)
+    try:
+        with Client(host["uri"], verify_ssl=verify) as c, requests.Session() as session:
+            if host.get("api_key"):
+                logged_in = c.call("auth.login_with_api_key", host["api_key"])
+            else:
+                logged_in = c.call("auth.login", host["username"], host["password"])
+            if not logged_in:
+                raise RuntimeError("login failed")
+            info = c.call("system.info")
+            truenas_version = re.sub(r"^TrueNAS-(SCALE-)?", "", info["version"])
+            uri = urlparse(host["uri"])
+            download_base = f"{'https' if uri.scheme == 'wss' else 'http'}://{uri.netloc}"
+            index = open_index(host_dir)
+            filename = take_backup(c, session, download_base, host_dir, index, info["hostname"], truenas_version,
+                                   store, retention, verify)
+            if filename:
+                row = index.execute("SELECT size, checksum FROM backups WHERE filename = ?", (filename,)).fetchone()
+                result.update(status="ok", file=os.path.join(name, filename), size=row["size"], digest=row["checksum"])
+            else:
+                result["error"] = "download failed"
+            index.close()
     except Exception as e:
-        print(f"An error occurred: {e}")
+        log(f"Error collecting backup: {e}")
+        result["error"] = str(e)
+    finally:
+        _log_context.prefix = ""
+    result["duration"] = round(time.monotonic() - start, 2)
+    return result
+
+def run_collector(hosts_path, output_dir, store, retention):
+    """
+    Back up every host in the host list concurrently, writing each into
+    <output-dir>/<name>/ and one summary report. Returns True if all succeeded.
+    """
+    inventory = load_collector_hosts(hosts_path)
+    hosts = inventory.get("hosts", [])
+    if not hosts:
+        print("No hosts found in host list")
+        return False
+    max_workers = max(1, int(inventory.get("max_workers", 4)))
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(hosts))) as executor:
+        results = list(executor.map(lambda host: collect_host(host, output_dir, store, retention), hosts))
+
+    report = {"timestamp": datetime.now().isoformat(timespec="seconds"), "hosts": results}
+    report_file = os.path.join(output_dir, "collect_report.json")
+    with open(f"{report_file}.tmp", "w") as f:
+        json.dump(report, f, indent=4)
+    fsync_replace(f"{report_file}.tmp", report_file)
+
+    failed = [result for result in results if result["status"] != "ok"]
+    print()
+    print("Host | Status | Duration | Size | File")
+    print("-" * 80)
+    for result in results:
+        print(f"{result['host']} | {result['status']} | {result['duration']}s | {result['size'] or '-'} | "
+              f"{result['file'] or result['error']}")
+    print(f"{len(results) - len(failed)}/{len(results)} host(s) backed up. Report saved to: {report_file}")
+    return not failed
 
 def main():
     """
@@ -39,41 +743,86 @@ def main():
     # Parse command-line arguments
     parser = argparse.ArgumentParser(description="Automated TrueNAS configuration backup utility.")
     parser.add_argument("--output-dir", required=True, help="Directory to save the backup file.")
+    parser.add_argument("--store", action="store_true",
+                        help="Store backups deduplicated and compressed by content digest, with each backup saved as a reference.")
+    parser.add_argument("--extract", nargs=2, metavar=("REFERENCE", "OUTPUT_FILE"),
+                        help="Write the tarball for a store reference (relative to --output-dir) to OUTPUT_FILE and exit.")
+    parser.add_argument("--if-changed", action="store_true",
+                        help="Only take a backup if the config database, secret seed or root authorized keys changed since the last one.")
+    parser.add_argument("--collect", metavar="HOSTS_FILE",
+                        help="Back up every host in a JSON host list concurrently into per-host directories.")
+    parser.add_argument("--list", action="store_true", help="List indexed backups and exit.")
+    parser.add_argument("--latest", action="store_true", help="Print the path of the newest indexed backup and exit.")
+    parser.add_argument("--host", help="Only list or look up backups of this hostname.")
+    parser.add_argument("--version", help="Only list or look up backups of this TrueNAS version.")
+    parser.add_argument("--verify", action="store_true", help="Check indexed backups against their manifests and exit.")
+    parser.add_argument("--reindex", action="store_true", help="Rebuild the index from the backups in --output-dir and exit.")
+    parser.add_argument("--prune", action="store_true", help="Apply the retention policy without taking a new backup.")
+    parser.add_argument("--keep-last", type=int, default=0, help="Keep the N most recent backups per host.")
+    parser.add_argument("--keep-daily", type=int, default=0, help="Keep the newest backup of each of the last N days per host.")
+    parser.add_argument("--keep-weekly", type=int, default=0, help="Keep the newest backup of each of the last N weeks per host.")
+    parser.add_argument("--keep-monthly", type=int, default=0, help="Keep the newest backup of each of the last N months per host.")
     args = parser.parse_args()
+    retention = (args.keep_last, args.keep_daily, args.keep_weekly, args.keep_monthly)
 
-    # Generate token and get UI port
-    with Client() as c:
-        token = c.call("auth.generate_token", 30, {}, False, True)
-        ui_port = c.call("system.general.config")["ui_httpsport"]
+    if args.extract:
+        extract_store_backup(os.path.join(args.output_dir, args.extract[0]), args.extract[1])
+        return
+    os.makedirs(args.output_dir, exist_ok=True)
+    if args.collect:
+        if args.if_changed:
+            parser.error("--if-changed only works for local backups, not with --collect.")
+        sys.exit(0 if run_collector(args.collect, args.output_dir, args.store, retention) else 1)
+    index = open_index(args.output_dir)
+    if args.list:
+        list_backups(index, args.host, args.version)
+        return
+    if args.latest:
+        sys.exit(0 if find_latest_backup(index, args.output_dir, args.host, args.version) else 1)
+    if args.verify:
+        sys.exit(0 if verify_backups(index, args.output_dir, args.host, args.version) else 1)
+    if args.reindex:
+        reindex_backups(index, args.output_dir)
+        return
+    if args.prune:
+        if not any(retention):
+            parser.error("--prune needs at least one --keep-* option.")
+        apply_retention(index, args.output_dir, *retention)
+        return
 
-    # Login with token and download configuration
-    with Client(uri=f"wss://localhost:{ui_port}/api/current", verify_ssl=False) as c:
-        result = c.call("auth.login_with_token", token)
-        print("Login result:", result)
+    if args.if_changed:
+        # Fingerprint before the download, so changes made while it runs trigger the next backup.
+        previous = load_state(args.output_dir)
+        fingerprint = fingerprint_config_files(previous)
+        if not config_changed(previous, fingerprint):
+            if fingerprint != previous:
+                save_state(args.output_dir, fingerprint)
+            print("Configuration unchanged since the last backup, skipping.")
+            return
 
-        try:
-            # Read TrueNAS version and hostname
-            with open('/etc/version', 'r', encoding='utf-8') as f:
-                truenas_version = f.read().strip()
-            with open('/etc/hostname', 'r', encoding='utf-8') as f:
-                hostname = f.read().strip()
-        except Exception as e:
-            print(f"Error reading TrueNAS version: {e}")
-            truenas_version = "unknown"
-
-        # Generate timestamp and backup filename
-        timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-        backup_filename = generate_backup_filename(hostname, truenas_version, timestamp)
-
-        # Download configuration
-        config_result = c.call("core.download", "config.save", [{"secretseed": True, "root_authorized_keys": True}], backup_filename)
-        download_path = config_result[1]
-        download_url = f"https://localhost:{ui_port}{download_path}"
+    try:
+        # Read TrueNAS version and hostname
+        with open('/etc/version', 'r', encoding='utf-8') as f:
+            truenas_version = f.read().strip()
+    except Exception as e:
+        print(f"Error reading TrueNAS version: {e}")
+        truenas_version = "unknown"
+    try:
+        with open('/etc/hostname', 'r', encoding='utf-8') as f:
+            hostname = f.read().strip()
+    except Exception:
+        hostname = socket.gethostname()
 
-        # Save backup file
-        output_file = os.path.join(args.output_dir, backup_filename)
-        download_backup_file(download_url, output_file)
-        print(f"Download successful. File saved to: {output_file}")
+    # One middleware session for the UI port and download requests. The
+    # download URL carries its own auth token, so no separate login is needed.
+    with Client(os.environ.get("TRUENAS_API_URI")) as c, requests.Session() as session:
+        ui_port = c.call("system.general.config")["ui_httpsport"]
+        filename = take_backup(c, session, f"https://localhost:{ui_port}", args.output_dir, index,
+                               hostname, truenas_version, args.store, retention)
+    if filename is None:
+        sys.exit(1)
+    if args.if_changed:
+        save_state(args.output_dir, fingerprint)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+"""
+TrueNAS system inventory and forum signature generator.
+
+Collects system info and pool topology in one middleware session, reads the
+motherboard from a dmidecode cache, and renders the forum signature HTML and a
+JSON inventory from the same snapshot.
+"""
+
+import argparse
+import html
+import json
+import math
+import os
+import subprocess
+import sys
+import tempfile
+from datetime import datetime, timezone
+
+from truenas_api_client import Client
+
+DEFAULT_CACHE_FILE = os.path.expanduser("~/.cache/truenas-scripts/baseboard.json")
+# Readable without root; used to notice a motherboard swap without running dmidecode.
+DMI_BOARD_NAME = "/sys/class/dmi/id/board_name"
+
+TIB = 1024 ** 4
+GIB = 1024 ** 3
+
+# Auxiliary vdev classes and their signature flags (Metadata, Log, Cache, Spare, Dedup).
+POOL_FLAGS = (("special", "M"), ("log", "L"), ("cache", "C"), ("spare", "S"), ("dedup", "D"))
+
+
+def format_number(value: float) -> str:
+    """Format a rounded number without trailing zeros (944, 817.25, 75.8)."""
+    return f"{value:.2f}".rstrip("0").rstrip(".")
+
+
+def format_size(size: int) -> str:
+    """Format a byte count in TiB or GiB, rounded half up to two decimals."""
+    unit, suffix = (TIB, "TiB") if size >= TIB else (GIB, "GiB")
+    return f"{format_number(math.floor(size / unit * 100 + 0.5) / 100)} {suffix}"
+
+
+def write_atomic(path: str, content: str) -> None:
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=f".{os.path.basename(path)}.")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def read_dmi_board_name() -> str:
+    try:
+        with open(DMI_BOARD_NAME, "r") as f:
+            return f.read().strip()
+    except OSError:
+        return ""
+
+
+def parse_dmidecode_baseboard(output: str) -> dict:
+    """Extract the first baseboard's manufacturer, product name and version from dmidecode -t baseboard."""
+    fields = {"Manufacturer": "manufacturer", "Product Name": "product_name", "Version": "version"}
+    board = {}
+    for line in output.splitlines():
+        key, separator, value = line.strip().partition(":")
+        if separator and key in fields and fields[key] not in board:
+            board[fields[key]] = value.strip()
+    return board
+
+
+def get_baseboard(cache_file: str, refresh: bool = False) -> dict:
+    """
+    Return the baseboard facts, running dmidecode only when the cache is missing,
+    refresh is requested, or the board name in sysfs no longer matches the cache.
+    """
+    board_name = read_dmi_board_name()
+    if not refresh:
+        try:
+            with open(cache_file, "r") as f:
+                cached = json.load(f)
+            if not board_name or cached.get("product_name") == board_name:
+                return cached
+        except (OSError, json.JSONDecodeError):
+            pass
+
+    try:
+        result = subprocess.run(["dmidecode", "-t", "baseboard"], capture_output=True, text=True)
+        board = parse_dmidecode_baseboard(result.stdout) if result.returncode == 0 else {}
+    except OSError:
+        board = {}
+    if not board.get("product_name"):
+        # dmidecode needs root; fall back to sysfs and do not cache a partial answer
+        return {"product_name": board_name or "Unknown"}
+
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        write_atomic(cache_file, json.dumps(board, indent=4))
+    except OSError as e:
+        print(f"Warning: Could not write baseboard cache {cache_file}: {e}", file=sys.stderr)
+    return board
+
+
+def pool_inventory(pool: dict) -> dict:
+    """Summarize a pool.query entry: data vdev layout, sizes and auxiliary vdev flags."""
+    topology = pool.get("topology") or {}
+    data = topology.get("data") or []
+    vdev_type = data[0]["type"] if data else "NONE"
+    size = int(pool.get("size_str") or pool.get("size") or 0)
+    free = int(pool.get("free_str") or pool.get("free") or 0)
+    return {
+        "name": pool["name"],
+        "status": pool.get("status"),
+        "vdevs": len(data),
+        "vdev_type": vdev_type,
+        # Single-disk vdevs (stripes) have no width
+        "width": len(data[0].get("children") or []) if data and vdev_type != "DISK" else None,
+        "size": size,
+        "free": free,
+        "flags": "".join(flag for name, flag in POOL_FLAGS if topology.get(name)),
+    }
+
+
+def collect_inventory(cache_file: str, refresh: bool = False) -> dict:
+    """Collect system info and pool topology in one middleware session."""
+    with Client(os.environ.get("TRUENAS_API_URI")) as client:
+        info = client.call("system.info")
+        pools = client.call("pool.query", [], {
+            "select": ["name", "status", "size", "size_str", "free", "free_str", "topology"],
+        })
+    return {
+        "generated_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "system": {
+            "hostname": info.get("hostname"),
+            "version": info.get("version"),
+            "cpu_model": info.get("model"),
+            "cores": info.get("cores"),
+            "physmem": info.get("physmem"),
+            "ecc_memory": info.get("ecc_memory"),
+        },
+        "motherboard": get_baseboard(cache_file, refresh),
+        "pools": [pool_inventory(pool) for pool in pools],
+    }
+
+
+def signature_lines(inventory: dict) -> list:
+    """Return the (label, value) pairs shown in the signature."""
+    system = inventory["system"]
+    memory = format_number(round(system["physmem"] / GIB * 10) / 10)
+    lines = [
+        ("TrueNAS Version", system["version"]),
+        ("CPU Model", system["cpu_model"]),
+        ("Physical Memory", f"{memory} GiB {'(ECC)' if system['ecc_memory'] else '(Non-ECC)'}"),
+        ("Motherboard", inventory["motherboard"].get("product_name", "Unknown")),
+    ]
+    for pool in inventory["pools"]:
+        fields = [pool["name"], f"{pool['vdevs']} x {pool['vdev_type']}"]
+        if pool["width"] is not None:
+            fields.append(f"{pool['width']} wide")
+        fields += [f"{format_size(pool['size'])} Total", f"{format_size(pool['free'])} Available"]
+        if pool["flags"]:
+            fields.append(pool["flags"])
+        lines.append(("Pool", " | ".join(fields)))
+    return lines
+
+
+def render_signature(inventory: dict) -> str:
+    rows = "\n".join(f"<b>{html.escape(label)}</b>: {html.escape(str(value))}<br>"
+                     for label, value in signature_lines(inventory))
+    return f"<details>\n<summary>My System</summary>\n<p>\n{rows}\n</p>\n</details>"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a TrueNAS forum signature and system inventory.")
+    parser.add_argument("--json", metavar="PATH",
+                        help="Also write the JSON inventory to PATH ('-' prints only the JSON to stdout)")
+    parser.add_argument("--cache-file", default=DEFAULT_CACHE_FILE,
+                        help=f"dmidecode baseboard cache (default: {DEFAULT_CACHE_FILE})")
+    parser.add_argument("--refresh", action="store_true", help="Re-read the baseboard with dmidecode")
+    args = parser.parse_args()
+
+    try:
+        inventory = collect_inventory(args.cache_file, args.refresh)
+    except Exception as e:
+        print(f"Error collecting system inventory: {e}", file=sys.stderr)
+        sys.exit(1)
+
+    if args.json == "-":
+        print(json.dumps(inventory, indent=4))
+        return
+    if args.json:
+        write_atomic(os.path.abspath(args.json), json.dumps(inventory, indent=4))
+
+    print("Paste the below details into your signature by clicking on your profile picture in the top right "
+          "and going to Summary -> Preferences -> Profile:")
+    print()
+    print(render_signature(inventory))
+
+
+if __name__ == "__main__":
+    main()
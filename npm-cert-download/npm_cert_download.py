@@ -5,10 +5,70 @@ import io
 from OpenSSL import crypto
 import os
 import argparse
+import json
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from requests.adapters import HTTPAdapter
 
 DEFAULT_NPM_MGMT_ENDPOINT = os.getenv('NPM_MGMT_ENDPOINT')
 DEFAULT_USERNAME = os.getenv('NPM_USERNAME')
 DEFAULT_PASSWORD = os.getenv('NPM_PASSWORD')
+DEFAULT_STATE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'npm_cert_download.state.json')
+
+# Cached tokens are renewed this long before NPM says they expire.
+TOKEN_EXPIRY_MARGIN = timedelta(minutes=5)
+
+DEFAULT_MAX_WORKERS = 4
+
+# (connect, read) timeouts for every NPM request, so a stalled connection cannot hang the scheduler.
+REQUEST_TIMEOUT = (10, 60)
+
+# Scheduler timing. NPM renews Let's Encrypt certificates 30 days before they expire. Until
+# then the scheduler checks at most once a day; inside the window it polls with backoff,
+# never waiting longer than a quarter of the remaining lifetime.
+RENEWAL_WINDOW = timedelta(days=30)
+MAX_CHECK_INTERVAL = timedelta(days=1)
+MIN_POLL_INTERVAL = timedelta(minutes=15)
+MAX_POLL_INTERVAL = timedelta(hours=6)
+# Doubling MIN_POLL_INTERVAL this many times already exceeds MAX_POLL_INTERVAL.
+MAX_POLL_DOUBLINGS = 5
+
+# One pooled HTTP session shared by every request, including concurrent bulk downloads.
+SESSION = requests.Session()
+
+class AuthenticationError(Exception):
+    pass
+
+def load_state(state_file):
+    try:
+        with open(state_file, 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+def save_state(state_file, state):
+    # The state holds a bearer token, so keep it private to the owner
+    tmp_file = f'{state_file}.tmp'
+    fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(state, f, indent=4)
+    os.replace(tmp_file, state_file)
+
+def parse_npm_time(value):
+    return datetime.fromisoformat(value.replace('Z', '+00:00'))
+
+def call_with_token(state, action):
+    # A cached token can be revoked before it expires, so retry once with a fresh one
+    for attempt in range(2):
+        token = get_cached_token(state, USERNAME, PASSWORD, refresh=attempt > 0)
+        try:
+            return action(token)
+        except AuthenticationError:
+            if attempt > 0:
+                raise
 
 def get_bearer_token(username, password):
     url = f'{NPM_MGMT_ENDPOINT}/api/tokens'
@@ -16,23 +76,222 @@ def get_bearer_token(username, password):
         'identity': username,
         'secret': password
     }
-    response = requests.post(url, json=data)
+    response = SESSION.post(url, json=data, timeout=REQUEST_TIMEOUT)
     if response.status_code == 200:
-        return response.json().get('token')
+        return response.json()
     else:
         raise Exception(f"Failed to authenticate: {response.text}")
 
+def get_cached_token(state, username, password, refresh=False):
+    cached = state.get('token')
+    if (not refresh and cached and cached['endpoint'] == NPM_MGMT_ENDPOINT and cached['username'] == username
+            and parse_npm_time(cached['expires']) - TOKEN_EXPIRY_MARGIN > datetime.now(timezone.utc)):
+        return cached['token']
+    result = get_bearer_token(username, password)
+    state['token'] = {
+        'endpoint': NPM_MGMT_ENDPOINT,
+        'username': username,
+        'token': result['token'],
+        'expires': result['expires'],
+    }
+    return result['token']
+
 def download_certificate(token, cert_id):
     url = f'{NPM_MGMT_ENDPOINT}/api/nginx/certificates/{cert_id}/download'
     headers = {
         'Authorization': f'Bearer {token}'
     }
-    response = requests.get(url, headers=headers)
+    response = SESSION.get(url, headers=headers, timeout=REQUEST_TIMEOUT)
     if response.status_code == 200:
         return response.content
+    elif response.status_code == 401:
+        raise AuthenticationError(response.text)
     else:
         raise Exception(f"Failed to download certificate: {response.text}")
 
+def get_certificate_metadata(token):
+    url = f'{NPM_MGMT_ENDPOINT}/api/nginx/certificates'
+    headers = {
+        'Authorization': f'Bearer {token}'
+    }
+    response = SESSION.get(url, headers=headers, timeout=REQUEST_TIMEOUT)
+    if response.status_code == 200:
+        return {cert['id']: cert for cert in response.json()}
+    elif response.status_code == 401:
+        raise AuthenticationError(response.text)
+    else:
+        raise Exception(f"Failed to list certificates: {response.text}")
+
+def certificate_unchanged(state, cert_id, metadata, cert_file, key_file):
+    previous = state.get('certificates', {}).get(str(cert_id))
+    return (previous is not None
+            and previous['expires_on'] == metadata.get('expires_on')
+            and previous['modified_on'] == metadata.get('modified_on')
+            and previous['cert_file'] == cert_file and previous['key_file'] == key_file
+            and 'not_after' in previous
+            and os.path.exists(cert_file) and os.path.exists(key_file))
+
+def write_atomic(path, data, mode=0o644):
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_file = tempfile.mkstemp(dir=directory, prefix=f'.{os.path.basename(path)}.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp_file, mode)
+        os.replace(tmp_file, path)
+    except BaseException:
+        os.remove(tmp_file)
+        raise
+
+def sync_certificate(token, state, cert_id, metadata, cert_file, key_file, force=False, import_enabled=False):
+    # A certificate whose current version was never imported (or whose import failed)
+    # is downloaded again so it can be imported
+    downloaded = state.get('certificates', {}).get(str(cert_id), {})
+    imported = state.get('imports', {}).get(str(cert_id), {})
+    not_imported = import_enabled and ('fingerprint' not in downloaded
+                                       or imported.get('fingerprint') != downloaded['fingerprint'])
+    if not force and not not_imported and certificate_unchanged(state, cert_id, metadata, cert_file, key_file):
+        return {'id': cert_id, 'name': metadata['nice_name'], 'status': 'unchanged', 'detail': cert_file}
+    zip_content = download_certificate(token, cert_id)
+    cert_data, private_key_data, cn, fingerprint, not_after = read_certificates(zip_content)
+    write_atomic(cert_file, cert_data)
+    write_atomic(key_file, private_key_data, 0o600)
+    state.setdefault('certificates', {})[str(cert_id)] = {
+        'expires_on': metadata.get('expires_on'),
+        'modified_on': metadata.get('modified_on'),
+        'cert_file': cert_file,
+        'key_file': key_file,
+        'name': metadata['nice_name'],
+        'not_after': not_after.isoformat(),
+        'fingerprint': fingerprint,
+    }
+    return {'id': cert_id, 'name': metadata['nice_name'], 'cn': cn, 'status': 'downloaded', 'detail': cert_file,
+            'fingerprint': fingerprint, 'cert_data': cert_data, 'key_data': private_key_data}
+
+def load_mapping(mapping_file):
+    with open(mapping_file, 'r') as f:
+        mapping = json.load(f)
+    for key, paths in mapping.get('certificates', {}).items():
+        if key != 'all' and not key.isdigit():
+            raise Exception(f"Mapping keys must be certificate IDs or 'all', got '{key}'")
+        if not paths.get('cert_file') or not paths.get('key_file'):
+            raise Exception(f"Mapping entry '{key}' needs a cert_file and key_file")
+    return mapping
+
+def mapping_max_workers(mapping):
+    return max(1, int(mapping.get('max_workers', DEFAULT_MAX_WORKERS)))
+
+def certificate_domain(metadata):
+    domains = metadata.get('domain_names') or [metadata['nice_name']]
+    return re.sub(r'[^A-Za-z0-9.-]', '_', domains[0].replace('*.', 'wildcard.'))
+
+def resolve_mapping(mapping, certificates):
+    # Explicit IDs win over the 'all' templates
+    entries = mapping.get('certificates', {})
+    targets = {}
+    if 'all' in entries:
+        for cert_id, metadata in certificates.items():
+            fields = {'id': cert_id, 'domain': certificate_domain(metadata)}
+            targets[cert_id] = (entries['all']['cert_file'].format(**fields), entries['all']['key_file'].format(**fields))
+    for key, paths in entries.items():
+        if key != 'all':
+            targets[int(key)] = (paths['cert_file'], paths['key_file'])
+    return targets
+
+def sync_bulk(token, state, mapping, force=False, import_enabled=False, cert_ids=None):
+    certificates = get_certificate_metadata(token)
+    targets = resolve_mapping(mapping, certificates)
+    if cert_ids is not None:
+        targets = {cert_id: paths for cert_id, paths in targets.items() if cert_id in cert_ids}
+
+    def sync_one(item):
+        cert_id, (cert_file, key_file) = item
+        if cert_id not in certificates:
+            return {'id': cert_id, 'name': '-', 'status': 'failed', 'detail': 'certificate not found'}
+        try:
+            return sync_certificate(token, state, cert_id, certificates[cert_id], cert_file, key_file, force, import_enabled)
+        except AuthenticationError:
+            raise
+        except Exception as e:
+            return {'id': cert_id, 'name': certificates[cert_id]['nice_name'], 'status': 'failed', 'detail': str(e)}
+
+    with ThreadPoolExecutor(max_workers=mapping_max_workers(mapping)) as executor:
+        return list(executor.map(sync_one, sorted(targets.items())))
+
+def print_results(results, import_enabled=False):
+    print("ID | Certificate | Status | " + ("Import | " if import_enabled else "") + "Detail")
+    print("-" * 50)
+    for result in results:
+        imported = f"{result.get('import', '-')} | " if import_enabled else ""
+        print(f"{result['id']} | {result['name']} | {result['status']} | {imported}{result['detail']}")
+
+def truenas_certificate_name(cert_id, fingerprint):
+    return f"npm_{cert_id}_{fingerprint.replace(':', '').lower()[:16]}"
+
+def import_certificates(state, results, ui_cert_id=None):
+    # Only certificates whose fingerprint is not in the import index touch TrueNAS
+    imports = state.setdefault('imports', {})
+    changed = []
+    for result in results:
+        if result['status'] != 'downloaded':
+            continue
+        if imports.get(str(result['id']), {}).get('fingerprint') == result['fingerprint']:
+            result['import'] = 'unchanged'
+        else:
+            changed.append(result)
+    if not changed:
+        return
+    try:
+        from truenas_api_client import Client
+    except ImportError:
+        raise Exception("Importing into TrueNAS needs truenas_api_client, which is only available on TrueNAS")
+
+    with Client(os.getenv('TRUENAS_API_URI')) as c:
+        ui_certificate = c.call('system.general.config')['ui_certificate']
+        ui_certificate_id = ui_certificate['id'] if isinstance(ui_certificate, dict) else ui_certificate
+        restart_ui = False
+        for result in changed:
+            previous = imports.get(str(result['id']))
+            name = truenas_certificate_name(result['id'], result['fingerprint'])
+            try:
+                # TrueNAS certificates cannot be edited, so an update imports a new one and moves users over
+                existing = c.call('certificate.query', [['name', '=', name]])
+                if existing:
+                    truenas_cert = existing[0]
+                else:
+                    truenas_cert = c.call('certificate.create', {
+                        'name': name,
+                        'create_type': 'CERTIFICATE_CREATE_IMPORTED',
+                        'certificate': result['cert_data'].decode(),
+                        'privatekey': result['key_data'].decode(),
+                    }, job=True)
+                used_by_ui = result['id'] == ui_cert_id or (previous and previous['truenas_id'] == ui_certificate_id)
+                if used_by_ui and ui_certificate_id != truenas_cert['id']:
+                    c.call('system.general.update', {'ui_certificate': truenas_cert['id']})
+                    ui_certificate_id = truenas_cert['id']
+                    restart_ui = True
+                if previous and previous['truenas_id'] != truenas_cert['id']:
+                    try:
+                        c.call('certificate.delete', previous['truenas_id'], job=True)
+                    except Exception as e:
+                        print(f"Kept previous TrueNAS certificate {previous['name']}: {e}")
+                imports[str(result['id'])] = {
+                    'fingerprint': result['fingerprint'],
+                    'truenas_id': truenas_cert['id'],
+                    'name': name,
+                }
+                result['import'] = 'imported'
+            except Exception as e:
+                result['import'] = 'failed'
+                result['status'] = 'failed'
+                result['detail'] = f"import failed: {e}"
+        if restart_ui:
+            c.call('system.general.ui_restart')
+            print("Restarted the TrueNAS web UI to use the new certificate")
+
 def read_certificates(zip_content):
     with zipfile.ZipFile(io.BytesIO(zip_content)) as z:
         cert_filename = None
@@ -50,25 +309,106 @@ def read_certificates(zip_content):
             cert_data = cert_file.read()
             cert = crypto.load_certificate(crypto.FILETYPE_PEM, cert_data)
             cn = cert.get_subject().CN
+            fingerprint = cert.digest('sha256').decode()
+            not_after = datetime.strptime(cert.get_notAfter().decode(), '%Y%m%d%H%M%SZ').replace(tzinfo=timezone.utc)
             with z.open(key_filename) as key_file:
                 private_key_data = key_file.read()
-            return cert_data, private_key_data, cn
+            return cert_data, private_key_data, cn, fingerprint, not_after
 
 def list_certificates(token):
     url = f'{NPM_MGMT_ENDPOINT}/api/nginx/certificates?expand=owner'
     headers = {
         'Authorization': f'Bearer {token}'
     }
-    response = requests.get(url, headers=headers)
+    response = SESSION.get(url, headers=headers, timeout=REQUEST_TIMEOUT)
     if response.status_code == 200:
         certificates = response.json()
         print("ID | Domains | Provider")
         print("-" * 50)
         for cert in certificates:
             print(f"{cert['id']} | {cert['nice_name']} | {cert['provider']}")
+    elif response.status_code == 401:
+        raise AuthenticationError(response.text)
     else:
         raise Exception(f"Failed to list certificates: {response.text}")
 
+def next_check_time(not_after, misses, now):
+    renew_at = not_after - RENEWAL_WINDOW
+    if now < renew_at:
+        return min(renew_at, now + MAX_CHECK_INTERVAL)
+    interval = min(MIN_POLL_INTERVAL * 2 ** min(misses, MAX_POLL_DOUBLINGS), MAX_POLL_INTERVAL, (not_after - now) / 4)
+    return now + max(interval, MIN_POLL_INTERVAL)
+
+def check_due_certificates(state_file, state, mapping, import_enabled=False, ui_cert_id=None):
+    schedule = state.setdefault('schedule', {})
+    now = datetime.now(timezone.utc)
+    targets = {str(cert_id) for cert_id in
+               call_with_token(state, lambda token: resolve_mapping(mapping, get_certificate_metadata(token)))}
+    for cert_id in list(schedule):
+        if cert_id not in targets:
+            del schedule[cert_id]
+    due = {int(cert_id) for cert_id in targets
+           if cert_id not in schedule or parse_npm_time(schedule[cert_id]['next_check']) <= now}
+    if not due:
+        return
+    try:
+        results = call_with_token(state, lambda token: sync_bulk(token, state, mapping, False, import_enabled, due))
+        if import_enabled:
+            import_certificates(state, results, ui_cert_id)
+    except Exception as e:
+        print(f"[{now.astimezone():%Y-%m-%d %H:%M:%S}] An error occurred: {e}", flush=True)
+        results = [{'id': cert_id, 'status': 'failed'} for cert_id in due]
+    for result in results:
+        entry = schedule.setdefault(str(result['id']), {'misses': 0})
+        cert_state = state.get('certificates', {}).get(str(result['id']))
+        if result['status'] == 'failed' or not cert_state:
+            entry['next_check'] = (now + MIN_POLL_INTERVAL).isoformat()
+            continue
+        not_after = parse_npm_time(cert_state['not_after'])
+        if result['status'] == 'downloaded' or now < not_after - RENEWAL_WINDOW:
+            entry['misses'] = 0
+        else:
+            entry['misses'] += 1
+        next_check = next_check_time(not_after, entry['misses'], now)
+        entry['next_check'] = next_check.isoformat()
+        print(f"[{now.astimezone():%Y-%m-%d %H:%M:%S}] Certificate {result['id']} ({result['name']}) {result['status']}, "
+              f"expires {not_after.astimezone():%Y-%m-%d}, next check {next_check.astimezone():%Y-%m-%d %H:%M}", flush=True)
+    save_state(state_file, state)
+
+def run_scheduler(state_file, state, mapping, import_enabled=False, ui_cert_id=None):
+    # Each certificate is only checked when its next_check time comes up
+    schedule = state.setdefault('schedule', {})
+    while True:
+        try:
+            check_due_certificates(state_file, state, mapping, import_enabled, ui_cert_id)
+        except Exception as e:
+            # NPM being unreachable must not stop a long-running scheduler
+            retry_at = datetime.now(timezone.utc) + MIN_POLL_INTERVAL
+            print(f"[{datetime.now().astimezone():%Y-%m-%d %H:%M:%S}] An error occurred: {e}, "
+                  f"retrying at {retry_at.astimezone():%H:%M}", flush=True)
+            time.sleep(MIN_POLL_INTERVAL.total_seconds())
+            continue
+        next_check = min((parse_npm_time(entry['next_check']) for entry in schedule.values()),
+                         default=datetime.now(timezone.utc) + MIN_POLL_INTERVAL)
+        time.sleep(max(60, (next_check - datetime.now(timezone.utc)).total_seconds()))
+
+def print_status(state):
+    certificates = state.get('certificates', {})
+    schedule = state.get('schedule', {})
+    now = datetime.now(timezone.utc)
+    print("ID | Certificate | Expires | Days left | Next check")
+    print("-" * 50)
+    for cert_id in sorted(set(certificates) | set(schedule), key=int):
+        cert_state = certificates.get(cert_id, {})
+        expires, days_left, next_check = '-', '-', 'not scheduled'
+        if 'not_after' in cert_state:
+            not_after = parse_npm_time(cert_state['not_after'])
+            expires = f"{not_after.astimezone():%Y-%m-%d %H:%M}"
+            days_left = (not_after - now).days
+        if cert_id in schedule:
+            next_check = f"{parse_npm_time(schedule[cert_id]['next_check']).astimezone():%Y-%m-%d %H:%M}"
+        print(f"{cert_id} | {cert_state.get('name', '-')} | {expires} | {days_left} | {next_check}")
+
 def main():
     parser = argparse.ArgumentParser(description='NPM Certificate Download Tool')
     parser.add_argument('--list-certs', action='store_true', help='List available certificates')
@@ -78,8 +418,19 @@ def main():
     parser.add_argument('--cert-file', help='Path where the downloaded certificate will be saved')
     parser.add_argument('--key-file', help='Path where the downloaded private key will be saved')
     parser.add_argument('--cert-id', type=int, help='ID of the certificate to download')
+    parser.add_argument('--state-file', default=DEFAULT_STATE_FILE, help='Path of the file caching the bearer token and certificate metadata')
+    parser.add_argument('--force', action='store_true', help='Download the certificate even if it is unchanged')
+    parser.add_argument('--import', dest='import_certs', action='store_true', help='Import changed certificates into TrueNAS')
+    parser.add_argument('--ui-cert-id', type=int, help='With --import, use this certificate for the TrueNAS web UI and restart the UI when it changes')
+    parser.add_argument('--mapping', help='JSON file mapping certificate IDs (or "all") to cert/key paths, for syncing many certificates in one run')
+    parser.add_argument('--schedule', action='store_true', help='Keep running and check each certificate when it is due for renewal')
+    parser.add_argument('--status', action='store_true', help='Show the expiry and next check time of every tracked certificate')
     args = parser.parse_args()
 
+    if args.status:
+        print_status(load_state(args.state_file))
+        return
+
     global NPM_MGMT_ENDPOINT, USERNAME, PASSWORD, CERT_FILE, KEY_FILE, CERT_ID
     
     NPM_MGMT_ENDPOINT = args.endpoint or DEFAULT_NPM_MGMT_ENDPOINT
@@ -92,31 +443,60 @@ def main():
         parser.error("Username is required. Provide it with --username or set NPM_USERNAME environment variable.")
     if not PASSWORD:
         parser.error("Password is required. Provide it with --password or set NPM_PASSWORD environment variable.")
-    try:
-        token = get_bearer_token(USERNAME, PASSWORD)
+    if args.mapping:
+        mapping = load_mapping(args.mapping)
+        # Mounted once so every bulk run (and every scheduler wake-up) reuses the same connection pool
+        SESSION.mount(NPM_MGMT_ENDPOINT, HTTPAdapter(pool_maxsize=mapping_max_workers(mapping)))
+    elif not args.list_certs:
+        CERT_FILE = args.cert_file
+        KEY_FILE = args.key_file
+        CERT_ID = args.cert_id
+        if not CERT_FILE:
+            parser.error("Certificate file path is required. Provide it with --cert-file.")
+        if not KEY_FILE:
+            parser.error("Key file path is required. Provide it with --key-file.")
+        if not CERT_ID:
+            parser.error("Certificate ID is required. Provide it with --cert-id.")
+    state = load_state(args.state_file)
+    if args.schedule:
+        if args.list_certs:
+            parser.error("--schedule needs --mapping or --cert-id, not --list-certs.")
+        if not args.mapping:
+            mapping = {'certificates': {str(CERT_ID): {'cert_file': CERT_FILE, 'key_file': KEY_FILE}}}
+        run_scheduler(args.state_file, state, mapping, args.import_certs, args.ui_cert_id)
+
+    def run(token):
         if args.list_certs:
             list_certificates(token)
+        elif args.mapping:
+            results = sync_bulk(token, state, mapping, args.force, args.import_certs)
+            if args.import_certs:
+                import_certificates(state, results, args.ui_cert_id)
+            print_results(results, args.import_certs)
+            return any(result['status'] == 'failed' for result in results)
         else:
-            CERT_FILE = args.cert_file
-            KEY_FILE = args.key_file
-            CERT_ID = args.cert_id
-            if not CERT_FILE:
-                parser.error("Certificate file path is required. Provide it with --cert-file.")
-            if not KEY_FILE:
-                parser.error("Key file path is required. Provide it with --key-file.")            
-            if not CERT_ID:
-                parser.error("Certificate ID is required. Provide it with --cert-id.")
-            os.makedirs(os.path.dirname(CERT_FILE), exist_ok=True)
-            os.makedirs(os.path.dirname(KEY_FILE), exist_ok=True)
-            zip_content = download_certificate(token, CERT_ID)
-            cert_data, private_key_data, cn = read_certificates(zip_content)
-            with open(CERT_FILE, 'wb') as cert_file:
-                cert_file.write(cert_data)
-            with open(KEY_FILE, 'wb') as key_file:
-                key_file.write(private_key_data)
-            print(f"Certificate for {cn} has been downloaded successfully")
+            metadata = get_certificate_metadata(token).get(CERT_ID)
+            if metadata is None:
+                raise Exception(f"Certificate {CERT_ID} not found")
+            result = sync_certificate(token, state, CERT_ID, metadata, CERT_FILE, KEY_FILE, args.force, args.import_certs)
+            if result['status'] == 'unchanged':
+                print(f"Certificate {CERT_ID} ({result['name']}) is unchanged, skipping download")
+            else:
+                print(f"Certificate for {result['cn']} has been downloaded successfully")
+                if args.import_certs:
+                    import_certificates(state, [result], args.ui_cert_id)
+                    print(f"TrueNAS import: {result['import']}" + (f" ({result['detail']})" if result['import'] == 'failed' else ""))
+        return False
+
+    try:
+        failed = call_with_token(state, run)
     except Exception as e:
         print(f"An error occurred: {e}")
+        failed = True
+    finally:
+        save_state(args.state_file, state)
+    if failed and args.mapping:
+        sys.exit(1)
 
 if __name__ == '__main__':
     main()
@@ -3,17 +3,34 @@
 TrueNAS Crontab Restore Script
 
 This script creates a post-init task to restore a crontab backup file.
-It can also create a backup of the current crontab configuration.
+It can also create a backup of the current crontab configuration, or reconcile
+all crontab restores and other post-init commands against a desired-state file.
 """
 
 import argparse
+import difflib
+import hashlib
+import json
 import os
+import shlex
 import subprocess
 import sys
+import tempfile
+from datetime import datetime
 from truenas_api_client import Client
 import urllib3
 
 
+# Number of crontab versions kept next to the backup file by default.
+DEFAULT_HISTORY_SIZE = 10
+
+# Comment prefix marking init scripts owned by reconcile mode.
+MANAGED_COMMENT_PREFIX = "[persistent-crontab] "
+
+# Init script fields compared when reconciling.
+RECONCILE_FIELDS = ("type", "command", "script", "when", "enabled", "timeout", "comment")
+
+
 def validate_backup_path(backup_path):
     """
     Validate the backup file path and check if it exists.
@@ -33,29 +50,106 @@ def validate_backup_path(backup_path):
     return os.path.abspath(backup_path)
 
 
-def backup_current_crontab(backup_path):
+def read_current_crontab(user=None):
+    """
+    Return the current crontab (of the given user), or an empty string if there is none.
+    """
+    command = ['crontab', '-u', user, '-l'] if user else ['crontab', '-l']
+    result = subprocess.run(command, capture_output=True, text=True)
+    if result.returncode != 0:
+        print(f"Warning: Could not read current crontab. It might be empty. {result.stderr}")
+        return ""
+    return result.stdout
+
+
+def write_atomic(path, content):
+    """
+    Write a file through a temporary file and rename, so readers never see a partial file.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=f".{os.path.basename(path)}.")
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def load_history_index(backup_path):
+    """
+    Load the index of versioned crontab snapshots kept next to the backup file.
+    """
+    try:
+        with open(f"{backup_path}.index.json", 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {"versions": []}
+
+
+def backup_current_crontab(backup_path, history_size=DEFAULT_HISTORY_SIZE, user=None):
     """
     Create a backup of the current crontab configuration.
+
+    Nothing is written when the crontab hash matches the last snapshot. Otherwise
+    the crontab is saved as a new version (<backup>.N), the backup file is
+    replaced, and versions beyond history_size are removed.
     """
     try:
-        result = subprocess.run(['crontab', '-l'], capture_output=True, text=True)
-        
-        if result.returncode != 0:
-            print(f"Warning: Could not read current crontab. It might be empty. {result.stderr}")
-            # Create an empty file as backup
-            with open(backup_path, 'w') as f:
-                pass
+        content = read_current_crontab(user)
+        digest = hashlib.sha256(content.encode()).hexdigest()
+        index = load_history_index(backup_path)
+        versions = index["versions"]
+
+        if versions and versions[-1]["sha256"] == digest and os.path.exists(backup_path):
+            print(f"Crontab unchanged since the last backup (version {versions[-1]['version']}), nothing written")
             return
-        
-        with open(backup_path, 'w') as f:
-            f.write(result.stdout)
-        
-        print(f"Current crontab configuration backed up to {backup_path}")
+
+        version = versions[-1]["version"] + 1 if versions else 1
+        write_atomic(f"{backup_path}.{version}", content)
+        write_atomic(backup_path, content)
+        versions.append({
+            "version": version,
+            "sha256": digest,
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+        })
+        for old_version in versions[:-history_size]:
+            try:
+                os.remove(f"{backup_path}.{old_version['version']}")
+            except FileNotFoundError:
+                pass
+        index["versions"] = versions[-history_size:]
+        write_atomic(f"{backup_path}.index.json", json.dumps(index, indent=4))
+
+        print(f"Current crontab configuration backed up to {backup_path} (version {version})")
     except Exception as e:
         print(f"Error backing up crontab: {e}")
         sys.exit(1)
 
 
+def diff_crontab(backup_path):
+    """
+    Print a unified diff between the last snapshot and the current crontab.
+    Returns True if they differ.
+    """
+    try:
+        with open(backup_path, 'r') as f:
+            snapshot = f.read()
+    except FileNotFoundError:
+        snapshot = ""
+        print(f"No snapshot found at {backup_path}")
+    current = read_current_crontab()
+    diff = list(difflib.unified_diff(snapshot.splitlines(keepends=True), current.splitlines(keepends=True),
+                                     fromfile=backup_path, tofile="crontab -l"))
+    if not diff:
+        print("Crontab matches the last snapshot")
+        return False
+    sys.stdout.writelines(line if line.endswith("\n") else line + "\n" for line in diff)
+    return True
+
+
 def check_and_create_init_script(backup_path, no_confirm=False):
     """
     Check if the crontab restore command already exists as an init script.
@@ -69,14 +163,16 @@ def check_and_create_init_script(backup_path, no_confirm=False):
     urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
     
     try:
-        with Client() as client:
-            # Query existing init scripts
-            init_scripts = client.call('initshutdownscript.query')
+        with Client(os.environ.get("TRUENAS_API_URI")) as client:
+            # Query existing crontab restore scripts
+            init_scripts = client.call('initshutdownscript.query', [
+                ["type", "=", "COMMAND"], ["command", "^", "crontab "],
+            ])
             
             # Check if crontab restore command already exists
             for script in init_scripts:
-                if script['type'] == 'COMMAND' and script['command'].startswith('crontab '):
-                    restore_path = script['command'].split(' ')[1]
+                if init_script_key(script) == ('crontab', 'root'):
+                    restore_path = shlex.split(script['command'])[-1]
                     
                     if restore_path == backup_path:
                         print(f"Crontab restore command already exists (ID: {script['id']})")
@@ -117,23 +213,242 @@ def check_and_create_init_script(backup_path, no_confirm=False):
         sys.exit(1)
 
 
+def crontab_restore_command(user, backup_path):
+    """
+    Return the init script command that restores a user's crontab from a backup file.
+    """
+    return f"crontab -u {shlex.quote(user)} {shlex.quote(backup_path)}"
+
+
+def init_script_key(script):
+    """
+    Return the identity of an init script: crontab restores are keyed by user, so a
+    changed backup path becomes an update. Other scripts are keyed by their command.
+    """
+    if script.get('type') == 'SCRIPT':
+        return ('SCRIPT', script.get('script'))
+    command = script.get('command') or ''
+    if command.startswith('crontab '):
+        try:
+            tokens = shlex.split(command)
+        except ValueError:
+            tokens = []
+        if len(tokens) >= 2:
+            return ('crontab', tokens[2] if tokens[1] == '-u' and len(tokens) > 3 else 'root')
+    return ('COMMAND', command)
+
+
+def load_desired_state(desired_path):
+    """
+    Load the desired-state file. Returns the crontabs to back up and the
+    (key, fields) pairs of every init script reconcile mode should manage.
+    """
+    try:
+        with open(desired_path, 'r') as f:
+            desired = json.load(f)
+    except (OSError, json.JSONDecodeError) as e:
+        print(f"Error reading desired-state file {desired_path}: {e}")
+        sys.exit(1)
+
+    crontabs = []
+    entries = []
+    for crontab in desired.get('crontabs', []):
+        user = crontab.get('user', 'root')
+        backup_path = validate_backup_path(crontab['backup_file'])
+        crontabs.append({
+            'user': user,
+            'backup_file': backup_path,
+            'history': max(1, crontab.get('history', DEFAULT_HISTORY_SIZE)),
+        })
+        entries.append({
+            'type': 'COMMAND',
+            'command': crontab_restore_command(user, backup_path),
+            'when': 'POSTINIT',
+            'enabled': crontab.get('enabled', True),
+            'timeout': crontab.get('timeout', 10),
+            'comment': f"{MANAGED_COMMENT_PREFIX}Restore crontab for {user} from {backup_path}",
+        })
+    for command in desired.get('commands', []):
+        entry = {'type': 'SCRIPT' if 'script' in command else 'COMMAND'}
+        if entry['type'] == 'SCRIPT':
+            entry['script'] = command['script']
+        else:
+            entry['command'] = command['command']
+        entry.update({
+            'when': command.get('when', 'POSTINIT'),
+            'enabled': command.get('enabled', True),
+            'timeout': command.get('timeout', 10),
+            'comment': MANAGED_COMMENT_PREFIX + command.get('comment', entry.get('command') or entry.get('script')),
+        })
+        entries.append(entry)
+
+    keyed = []
+    seen = set()
+    for entry in entries:
+        key = init_script_key(entry)
+        if key in seen:
+            print(f"Error: {desired_path} declares {key[0]} {key[1]} more than once")
+            sys.exit(1)
+        seen.add(key)
+        keyed.append((key, entry))
+    return crontabs, keyed
+
+
+def is_managed_script(script):
+    return (script.get('comment') or '').startswith(MANAGED_COMMENT_PREFIX)
+
+
+def plan_reconcile(desired, existing):
+    """
+    Compare the desired init scripts with the existing ones.
+    Returns (creates, updates, deletes, unchanged); updates are (script, changes) pairs.
+
+    Only scripts with the managed comment prefix are ever deleted. A crontab restore
+    without the prefix is adopted (updated in place) when its user is declared, and
+    left alone otherwise.
+    """
+    desired_keys = {key for key, _ in desired}
+    existing_by_key = {}
+    deletes = []
+    # Managed scripts first, so an unmanaged one is only adopted when nothing managed matches
+    for script in sorted(existing, key=lambda script: (not is_managed_script(script), script['id'])):
+        key = init_script_key(script)
+        if is_managed_script(script):
+            if key in existing_by_key:
+                deletes.append(script)
+            else:
+                existing_by_key[key] = script
+        elif key in desired_keys and key not in existing_by_key:
+            existing_by_key[key] = script
+
+    creates = []
+    updates = []
+    unchanged = []
+    for key, entry in desired:
+        script = existing_by_key.pop(key, None)
+        if script is None:
+            creates.append(entry)
+            continue
+        changes = {field: value for field, value in entry.items() if script.get(field) != value}
+        if changes:
+            updates.append((script, changes))
+        else:
+            unchanged.append(script)
+    deletes.extend(existing_by_key.values())
+    return creates, updates, deletes, unchanged
+
+
+def describe_init_script(script):
+    return f"{script.get('when')} {script.get('script') if script.get('type') == 'SCRIPT' else script.get('command')}"
+
+
+def print_plan(creates, updates, deletes, unchanged):
+    print(f"Plan: {len(creates)} to create, {len(updates)} to update, {len(deletes)} to delete, "
+          f"{len(unchanged)} unchanged")
+    for entry in creates:
+        print(f"  + create  {describe_init_script(entry)}")
+    for script, changes in updates:
+        print(f"  ~ update  ID {script['id']}: {describe_init_script(script)}")
+        for field, value in changes.items():
+            print(f"              {field}: {script.get(field)!r} -> {value!r}")
+    for script in deletes:
+        print(f"  - delete  ID {script['id']}: {describe_init_script(script)}")
+
+
+def reconcile_init_scripts(desired_path, plan_only=False):
+    """
+    Back up every crontab in the desired-state file and converge the managed init
+    scripts to it: all creates, updates and deletes are applied in one middleware
+    session without prompting.
+    """
+    crontabs, desired = load_desired_state(desired_path)
+
+    if not plan_only:
+        for crontab in crontabs:
+            backup_current_crontab(crontab['backup_file'], crontab['history'], crontab['user'])
+
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+    failures = 0
+    try:
+        with Client(os.environ.get("TRUENAS_API_URI")) as client:
+            # Only fetch the scripts reconcile mode owns, plus crontab restores created by the default mode
+            existing = client.call('initshutdownscript.query', [
+                ["OR", [["comment", "^", MANAGED_COMMENT_PREFIX], ["command", "^", "crontab "]]],
+            ], {"select": ["id", *RECONCILE_FIELDS]})
+
+            creates, updates, deletes, unchanged = plan_reconcile(desired, existing)
+            print_plan(creates, updates, deletes, unchanged)
+            if plan_only or not (creates or updates or deletes):
+                return
+
+            for entry in creates:
+                try:
+                    result = client.call('initshutdownscript.create', entry)
+                    print(f"Created init script (ID: {result['id']}): {describe_init_script(entry)}")
+                except Exception as e:
+                    print(f"Error creating init script {describe_init_script(entry)}: {e}")
+                    failures += 1
+            for script, changes in updates:
+                try:
+                    client.call('initshutdownscript.update', script['id'], changes)
+                    print(f"Updated init script (ID: {script['id']})")
+                except Exception as e:
+                    print(f"Error updating init script (ID: {script['id']}): {e}")
+                    failures += 1
+            for script in deletes:
+                try:
+                    client.call('initshutdownscript.delete', script['id'])
+                    print(f"Deleted init script (ID: {script['id']}): {describe_init_script(script)}")
+                except Exception as e:
+                    print(f"Error deleting init script (ID: {script['id']}): {e}")
+                    failures += 1
+    except Exception as e:
+        print(f"Error managing init scripts: {e}")
+        sys.exit(1)
+
+    if failures:
+        print(f"{failures} change(s) failed")
+        sys.exit(1)
+
+
 def main():
     """
     Main function to handle the crontab backup and restoration setup.
     """
     parser = argparse.ArgumentParser(description="TrueNAS crontab backup and restoration setup.")
-    parser.add_argument("--crontab-backup-file", required=True, 
+    parser.add_argument("--crontab-backup-file", 
                         help="Path to crontab backup file (e.g., /mnt/tank/dataset/crontab.bak")
     parser.add_argument("--no-confirm", action="store_true",
                         help="Automatically update existing init scripts without confirmation (if needed)")
+    parser.add_argument("--history", type=int, default=DEFAULT_HISTORY_SIZE,
+                        help=f"Number of crontab versions to keep (default: {DEFAULT_HISTORY_SIZE})")
+    parser.add_argument("--diff", action="store_true",
+                        help="Show changes between the last snapshot and the current crontab, then exit")
+    parser.add_argument("--reconcile", metavar="FILE",
+                        help="Reconcile crontab restores and other post-init commands with a desired-state JSON file")
+    parser.add_argument("--plan", action="store_true",
+                        help="With --reconcile, print the plan without backing up or changing anything")
     
     args = parser.parse_args()
+
+    if args.reconcile:
+        reconcile_init_scripts(args.reconcile, args.plan)
+        print("Done!")
+        return
+    if args.plan:
+        parser.error("--plan requires --reconcile")
+    if not args.crontab_backup_file:
+        parser.error("--crontab-backup-file is required unless --reconcile is used")
     
     # Validate backup path
     backup_path = validate_backup_path(args.crontab_backup_file)
-    
+
+    if args.diff:
+        sys.exit(1 if diff_crontab(backup_path) else 0)
+
     # Backup current crontab
-    backup_current_crontab(backup_path)
+    backup_current_crontab(backup_path, max(1, args.history))
     
     # Check and create init script
     check_and_create_init_script(backup_path, args.no_confirm)
@@ -2,4 +2,4 @@
 # Legacy script to ensure compatibility with old versions.
 
 SCRIPT_DIR="$(dirname "$(readlink -f "$0")")"
-python3 "$SCRIPT_DIR/update_apps.py"
\ No newline at end of file
+python3 "$SCRIPT_DIR/update_apps.py" "$@"
\ No newline at end of file
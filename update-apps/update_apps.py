@@ -1,4 +1,5 @@
 #!/usr/bin/env python3
+import argparse
 import os
 import sys
 import json
@@ -6,13 +7,53 @@ import socket
 import datetime
 import subprocess
 import re
+import signal
 import time
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from contextlib import contextmanager
 from pathlib import Path
 
+import requests
+
+# Only upgradable catalog apps are needed, with just the fields used for upgrading them.
+APP_QUERY_FILTERS = [["custom_app", "=", False], ["upgrade_available", "=", True]]
+APP_QUERY_OPTIONS = {"select": ["name", "version", "upgrade_available", "custom_app", "metadata.name", "metadata.train"]}
+
+# Webhook sinks: (display name, config section, payload key, maximum message length).
+WEBHOOK_SINKS = [
+    ("Discord", "discord", "content", 2000),
+    ("Slack", "slack", "text", 40000),
+]
+WEBHOOK_CONTINUED = "(continued)"
+
+# Seconds between daemon checks that the idle websocket session is still open.
+DAEMON_PING_INTERVAL = 60
+
+# Persisted between runs next to update_apps.json (e.g. when the catalog was last synced).
+STATE_FILE = "update_apps.state.json"
+
+# Per-thread log buffer used by concurrent upgrades so each app's lines stay grouped.
+_log_buffer = threading.local()
+
 
 def log(message: str) -> None:
     timestamp = datetime.datetime.now().strftime("[%Y-%m-%d %H:%M:%S]")
-    print(f"{timestamp} {message}")
+    lines = getattr(_log_buffer, "lines", None)
+    if lines is not None:
+        lines.append(f"{timestamp} {message}")
+        return
+    print(f"{timestamp} {message}", flush=True)
+
+
+def emit_lines(lines: list) -> None:
+    """Output already formatted log lines, keeping them in the current thread's buffer if it has one."""
+    buffer = getattr(_log_buffer, "lines", None)
+    if buffer is not None:
+        buffer.extend(lines)
+        return
+    for line in lines:
+        print(line, flush=True)
 
 
 def parse_toml(config_path: str) -> dict:
@@ -102,44 +143,431 @@ def load_config(script_dir: str) -> dict:
         "discord": {"enabled": False, "webhook_url": ""},
         "slack": {"enabled": False, "webhook_url": ""},
         "exclude": {"apps": []},
+        "upgrade": {"max_workers": 1, "timeout": 300},
+        "middleware": {"transport": "auto"},
+        "catalog": {"min_sync_interval": 0},
+        "prepull": {"enabled": False, "max_workers": 2, "timeout": 600},
+        "schedule": {"apps": {}},
+        "notifications": {"timeout": 30, "max_retries": 3},
+        "metrics": {"enabled": False, "textfile": "", "history_size": 100},
+        "daemon": {"check_interval": 3600, "debounce": 60, "window": {}},
         "debug": {"enabled": False, "dry_run": False}
     }
 
 
-def run_command(command: str) -> str:
-    """Run a shell command and return its standard output. Logs error if command fails."""
+def load_state(state_path: str) -> dict:
+    """Load the persisted run state, returning an empty state if it is missing or unreadable."""
+    try:
+        with open(state_path, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, json.JSONDecodeError) as e:
+        log(f"Error reading state file {state_path}, starting fresh: {e}")
+        return {}
+
+
+def write_atomic(path: str, content: str) -> None:
+    """Write a file via a temporary file and rename so readers never see a partial file."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+
+def save_state(state_path: str, state: dict) -> None:
+    """Atomically write the run state next to the config file."""
+    try:
+        write_atomic(state_path, json.dumps(state, indent=4))
+    except OSError as e:
+        log(f"Error writing state file {state_path}: {e}")
+
+
+class RunMetrics:
+    """Timing spans, per-app durations and counters collected during one run."""
+
+    def __init__(self):
+        self.started = time.time()
+        self.spans = {}
+        self.apps = {}
+        self.upgrades = []
+        self.counters = {"apps_found": 0, "apps_upgraded": 0, "apps_failed": 0, "apps_excluded": 0, "poll_attempts": 0}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name: str):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.spans[name] = self.spans.get(name, 0.0) + time.monotonic() - start
+
+    def record_app(self, app_name: str, phase: str, seconds: float) -> None:
+        with self._lock:
+            self.apps.setdefault(app_name, {})[phase] = round(seconds, 3)
+
+    def to_report(self, hostname: str, exit_code: int) -> dict:
+        return {
+            "hostname": hostname,
+            "started": datetime.datetime.fromtimestamp(self.started).isoformat(timespec="seconds"),
+            "timestamp": self.started,
+            "exit_code": exit_code,
+            "spans": {name: round(seconds, 3) for name, seconds in self.spans.items()},
+            "apps": self.apps,
+            "upgrades": list(self.upgrades),
+            "counters": dict(self.counters),
+        }
+
+
+def prometheus_label(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def format_prometheus_metrics(report: dict) -> str:
+    """Render a run report in the Prometheus text exposition format for the node-exporter textfile collector."""
+    host = f'host="{prometheus_label(report["hostname"])}"'
+    lines = [
+        "# HELP update_apps_last_run_timestamp_seconds Start time of the last update_apps run.",
+        "# TYPE update_apps_last_run_timestamp_seconds gauge",
+        f"update_apps_last_run_timestamp_seconds{{{host}}} {report['timestamp']:.0f}",
+        "# HELP update_apps_last_run_success Whether the last update_apps run exited successfully.",
+        "# TYPE update_apps_last_run_success gauge",
+        f"update_apps_last_run_success{{{host}}} {1 if report['exit_code'] == 0 else 0}",
+        "# HELP update_apps_phase_duration_seconds Time spent in each phase of the last run.",
+        "# TYPE update_apps_phase_duration_seconds gauge",
+    ]
+    for phase, seconds in sorted(report["spans"].items()):
+        lines.append(f'update_apps_phase_duration_seconds{{{host},phase="{prometheus_label(phase)}"}} {seconds}')
+    lines += [
+        "# HELP update_apps_app_duration_seconds Time spent on each app in the last run, by phase.",
+        "# TYPE update_apps_app_duration_seconds gauge",
+    ]
+    for app_name, phases in sorted(report["apps"].items()):
+        for phase, seconds in sorted(phases.items()):
+            lines.append(f'update_apps_app_duration_seconds{{{host},app="{prometheus_label(app_name)}",phase="{prometheus_label(phase)}"}} {seconds}')
+    for name, value in sorted(report["counters"].items()):
+        lines += [
+            f"# HELP update_apps_{name} Number of {name.replace('_', ' ')} in the last run.",
+            f"# TYPE update_apps_{name} gauge",
+            f"update_apps_{name}{{{host}}} {value}",
+        ]
+    return "\n".join(lines) + "\n"
+
+
+def export_metrics(config: dict, base_dir: str, report: dict) -> None:
+    """Write the JSON run report, append it to the bounded history and update the Prometheus textfile."""
+    metrics_config = config.get("metrics", {})
+    if not metrics_config.get("enabled", False):
+        return
+    report_file = os.path.join(base_dir, metrics_config.get("report_file", "update_apps.report.json"))
+    history_file = os.path.join(base_dir, metrics_config.get("history_file", "update_apps.history.jsonl"))
+    history_size = metrics_config.get("history_size", 100)
+    textfile = metrics_config.get("textfile", "")
+    try:
+        write_atomic(report_file, json.dumps(report, indent=4) + "\n")
+        history = []
+        if os.path.isfile(history_file):
+            with open(history_file, 'r') as f:
+                history = [line for line in f.read().splitlines() if line.strip()]
+        history.append(json.dumps(report))
+        write_atomic(history_file, "\n".join(history[-history_size:]) + "\n")
+        if textfile:
+            write_atomic(textfile, format_prometheus_metrics(report))
+    except OSError as e:
+        log(f"Error writing metrics: {e}")
+
+
+class MiddlewareError(Exception):
+    """Raised when a middleware call fails."""
+
+
+def run_midclt(method: str, *params, job: bool = False):
+    """Call a middleware method by spawning midclt and return the decoded result."""
+    command = ["midclt", "call"]
+    if job:
+        command.append("-job")
+    command.append(method)
+    command.extend(json.dumps(param) for param in params)
+    result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    if result.returncode != 0:
+        raise MiddlewareError(f"{method}: {result.stderr.strip() or f'midclt exited with {result.returncode}'}")
+    output = result.stdout.strip()
+    if not output:
+        return None
     try:
-        result = subprocess.run(
-            command,
-            shell=True,
-            check=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True
-        )
-        return result.stdout.strip()
-    except subprocess.CalledProcessError as e:
-        if e.stderr:
-            log(f"Command error: {e.stderr}")
-        return ""
-
-
-def send_webhook_notification(webhook_url: str, content: str) -> bool:
-    """Send notification to a webhook (Discord or Slack)."""
-    if not webhook_url:
-        return False
+        return json.loads(output)
+    except json.JSONDecodeError:
+        return output
+
+
+class MiddlewareClient:
+    """Middleware connection reused for every call made during a run.
+
+    A single truenas_api_client websocket session is opened when the module is
+    available, otherwise each call falls back to spawning midclt.
+    """
+
+    def __init__(self, transport: str = "auto", debug_enabled: bool = False, uri: str = None, api_key: str = None, verify_ssl: bool = True):
+        self.debug_enabled = debug_enabled
+        self.poll_attempts = 0
+        self.fallback_reason = None
+        self._client = None
+        self._job_events = {}
+        self._job_events_lock = threading.Lock()
+        self._watching_jobs = None
+        if uri:
+            # Remote hosts are only reachable over the websocket API.
+            transport = "websocket"
+        if transport in ("auto", "websocket"):
+            try:
+                from truenas_api_client import Client
+                self._client = Client(uri or os.environ.get("TRUENAS_API_URI"), verify_ssl=verify_ssl)
+                if api_key and not self._client.call("auth.login_with_api_key", api_key):
+                    raise MiddlewareError("API key login failed")
+            except Exception as e:
+                self.close()
+                if transport == "websocket":
+                    raise MiddlewareError(f"Unable to connect to middleware websocket: {e}") from e
+                self.fallback_reason = str(e)
+                if debug_enabled:
+                    log(f"DEBUG: Websocket client unavailable ({e}), falling back to midclt")
+        if debug_enabled:
+            log(f"DEBUG: Using {self.transport} middleware transport")
+
+    @property
+    def transport(self) -> str:
+        return "websocket" if self._client is not None else "midclt"
+
+    def call(self, method: str, *params, job: bool = False):
+        """Call a middleware method, waiting for the job to finish when job is True."""
+        if self._client is None:
+            return run_midclt(method, *params, job=job)
+        try:
+            return self._client.call(method, *params, job=job)
+        except Exception as e:
+            raise MiddlewareError(f"{method}: {e}") from e
+
+    def run_job(self, method: str, *params, timeout: float = 300):
+        """Start a middleware job and return its result once it finishes, or raise after timeout seconds."""
+        job_id = self.call(method, *params)
+        return self.wait_job(method, job_id, timeout)
+
+    def watch_jobs(self) -> bool:
+        """Subscribe once to job state changes. Returns False when the transport has no events."""
+        with self._job_events_lock:
+            if self._watching_jobs is None:
+                try:
+                    self._watching_jobs = self.subscribe("core.get_jobs", self._on_job_event)
+                except MiddlewareError as e:
+                    if self.debug_enabled:
+                        log(f"DEBUG: Job events unavailable ({e}), polling jobs instead")
+                    self._watching_jobs = False
+            return self._watching_jobs
+
+    def _on_job_event(self, mtype, **message):
+        if (message.get("fields") or {}).get("state") in ("SUCCESS", "FAILED", "ABORTED"):
+            with self._job_events_lock:
+                event = self._job_events.get(message.get("id"))
+            if event is not None:
+                event.set()
+
+    def wait_job(self, method: str, job_id: int, timeout: float = 300):
+        """Wait until the job finishes, checking core.get_jobs with a delay that backs off from 0.5s up to 10s.
+
+        Over the websocket transport the wait is cut short as soon as the middleware
+        reports the job finished; with midclt the job is only polled.
+        """
+        deadline = time.monotonic() + timeout
+        delay = 0.5
+        event = None
+        if self.watch_jobs():
+            event = threading.Event()
+            with self._job_events_lock:
+                self._job_events[job_id] = event
+        try:
+            while True:
+                self.poll_attempts += 1
+                jobs = self.call("core.get_jobs", [["id", "=", job_id]])
+                if jobs:
+                    job = jobs[0]
+                    state = job.get("state")
+                    if state == "SUCCESS":
+                        return job.get("result")
+                    if state in ("FAILED", "ABORTED"):
+                        raise MiddlewareError(f"{method} job {job_id} {state.lower()}: {job.get('error')}")
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise MiddlewareError(f"{method} job {job_id} did not finish within {timeout}s")
+                if event is not None:
+                    event.wait(min(delay, remaining))
+                    event.clear()
+                else:
+                    time.sleep(min(delay, remaining))
+                delay = min(delay * 1.5, 10)
+        finally:
+            if event is not None:
+                with self._job_events_lock:
+                    self._job_events.pop(job_id, None)
+
+    def ensure_connected(self) -> None:
+        """Raise MiddlewareError if the websocket session has dropped. midclt has no session to lose."""
+        if self._client is None:
+            return
+        try:
+            self._client.call("core.ping")
+        except Exception as e:
+            raise MiddlewareError(f"websocket connection lost: {e}") from e
+
+    def subscribe(self, name: str, callback) -> bool:
+        """Subscribe to a middleware event. Returns False when the transport has no event support."""
+        if self._client is None:
+            return False
+        try:
+            self._client.subscribe(name, callback)
+        except Exception as e:
+            raise MiddlewareError(f"subscribe {name}: {e}") from e
+        return True
+
+    def close(self) -> None:
+        if self._client is not None:
+            try:
+                self._client.close()
+            except Exception:
+                pass
+            self._client = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def compare_transports(iterations: int) -> None:
+    """Time the same middleware call over midclt and the websocket client."""
+    log(f"Timing {iterations} x system.info per transport...")
+    timings = {}
+    for transport in ("midclt", "websocket"):
+        start = time.monotonic()
+        try:
+            with MiddlewareClient(transport) as client:
+                connected = time.monotonic()
+                for _ in range(iterations):
+                    client.call("system.info")
+        except MiddlewareError as e:
+            log(f"   - {transport}: unavailable ({e})")
+            continue
+        finished = time.monotonic()
+        timings[transport] = finished - start
+        log(f"   - {transport}: {finished - start:.3f}s total, "
+            f"{connected - start:.3f}s connect, {(finished - connected) / iterations * 1000:.1f}ms per call")
+    if len(timings) == 2 and timings["websocket"] > 0:
+        log(f"Websocket client is {timings['midclt'] / timings['websocket']:.1f}x faster "
+            f"({timings['midclt'] - timings['websocket']:.3f}s saved)")
+
+
+def split_message(header: str, lines: list, limit: int) -> list:
+    """Split a header and lines into messages no longer than limit characters.
+
+    Messages after the first start with a continuation marker, and a line that is
+    too long on its own is truncated.
+    """
+    messages = []
+    current = header
+    for line in lines:
+        if len(line) > limit - len(WEBHOOK_CONTINUED) - 1:
+            line = line[:limit - len(WEBHOOK_CONTINUED) - 2] + "…"
+        if len(current) + 1 + len(line) > limit:
+            messages.append(current)
+            current = WEBHOOK_CONTINUED
+        current += "\n" + line
+    messages.append(current)
+    return messages
+
+
+def get_retry_delay(response, attempt: int) -> float:
+    """Return how long to wait before retrying a rate-limited or failed webhook request."""
+    retry_after = response.headers.get("Retry-After") if response is not None else None
+    if response is not None and retry_after is None:
+        try:
+            retry_after = response.json().get("retry_after")
+        except ValueError:
+            pass
     try:
-        import requests
-        headers = {'Content-Type': 'application/json'}
-        payload = {'content': content}
-        response = requests.post(webhook_url, headers=headers, json=payload, timeout=10)
-        return response.status_code == 200
-    except Exception as error:
-        log(f"Webhook notification error: {error}")
-        return False
+        return max(0.0, float(retry_after))
+    except (TypeError, ValueError):
+        return min(2 ** attempt, 30)
+
+
+def post_webhook_messages(session: requests.Session, name: str, url: str, payload_key: str, messages: list, deadline: float, max_retries: int) -> bool:
+    """Post messages to one webhook in order, retrying rate limits and server errors until the deadline."""
+    for message in messages:
+        attempt = 0
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                log(f"{name} notification timed out")
+                return False
+            response = None
+            try:
+                response = session.post(url, json={payload_key: message}, timeout=(min(5, remaining), remaining))
+            except requests.RequestException as e:
+                error = str(e)
+            else:
+                if 200 <= response.status_code < 300:
+                    # Discord reports an exhausted bucket before the next request would be rejected.
+                    if response.headers.get("X-RateLimit-Remaining") == "0":
+                        reset_after = float(response.headers.get("X-RateLimit-Reset-After") or 0)
+                        time.sleep(min(reset_after, max(0.0, deadline - time.monotonic())))
+                    break
+                error = f"HTTP {response.status_code}: {response.text[:200]}"
+                if response.status_code != 429 and response.status_code < 500:
+                    log(f"{name} notification failed: {error}")
+                    return False
+            delay = get_retry_delay(response, attempt)
+            attempt += 1
+            if attempt > max_retries or time.monotonic() + delay >= deadline:
+                log(f"{name} notification failed after {attempt} attempt(s): {error}")
+                return False
+            time.sleep(delay)
+    return True
+
+
+def send_notifications(config: dict, header: str, lines: list) -> dict:
+    """Send a notification to every enabled webhook concurrently.
+
+    Each webhook gets its own session so split messages reuse one connection, and the
+    whole dispatch is bounded by notifications.timeout seconds. Returns sink name -> success.
+    """
+    notification_config = config.get("notifications", {})
+    deadline = time.monotonic() + notification_config.get("timeout", 30)
+    max_retries = notification_config.get("max_retries", 3)
+    sinks = [
+        (name, config.get(key, {}).get("webhook_url", ""), payload_key, limit)
+        for name, key, payload_key, limit in WEBHOOK_SINKS
+        if config.get(key, {}).get("enabled", False) and config.get(key, {}).get("webhook_url", "")
+    ]
+    if not sinks:
+        return {}
 
+    def send(name, url, payload_key, limit):
+        with requests.Session() as session:
+            return post_webhook_messages(session, name, url, payload_key, split_message(header, lines, limit), deadline, max_retries)
 
-def upgrade_app(app: dict, config: dict, log_content: list, debug_enabled: bool, dry_run: bool) -> None:
+    results = {}
+    with ThreadPoolExecutor(max_workers=len(sinks)) as executor:
+        futures = {executor.submit(send, *sink): sink[0] for sink in sinks}
+        for future in as_completed(futures):
+            try:
+                results[futures[future]] = future.result()
+            except Exception as e:
+                log(f"{futures[future]} notification error: {e}")
+                results[futures[future]] = False
+    return results
+
+
+def upgrade_app(client: MiddlewareClient, app: dict, config: dict, log_content: list, debug_enabled: bool, dry_run: bool, metrics: RunMetrics = None) -> None:
     """Upgrade a single app if eligible."""
     app_name = app.get("name", "")
     current_version = app.get("version", "")
@@ -159,52 +587,300 @@ def upgrade_app(app: dict, config: dict, log_content: list, debug_enabled: bool,
         new_version = f"{current_version} (dry-run)"
         log_content.append(f"{app_name} | {current_version} → {new_version}")
     else:
-        upgrade_result = run_command(f"midclt call app.upgrade \"{app_name}\"")
-        if upgrade_result is not None:
-            new_version = "unknown"
-            max_attempts = 60
-            attempts = 0
-            while (new_version == "unknown" or new_version == current_version) and attempts < max_attempts:
-                app_config = run_command(f"midclt call app.config \"{app_name}\"")
-                if app_config:
-                    config_data = json.loads(app_config)
-                    new_version = config_data.get("ix_context", {}).get("app_metadata", {}).get("version", "unknown")
-                if new_version == "unknown" or new_version == current_version:
-                    time.sleep(5)
-                    attempts += 1
+        timeout = config.get("upgrade", {}).get("timeout", 300)
+        start = time.monotonic()
+        try:
+            upgrade_result = client.run_job("app.upgrade", app_name, timeout=timeout)
+        except MiddlewareError as e:
+            log(f"   - Upgrade failed after {time.monotonic() - start:.1f}s: {e}")
+            if metrics:
+                metrics.record_app(app_name, "upgrade", time.monotonic() - start)
+        else:
+            duration = time.monotonic() - start
+            if metrics:
+                metrics.record_app(app_name, "upgrade", duration)
+            new_version = upgrade_result.get("version") if isinstance(upgrade_result, dict) else None
+            if not new_version:
+                try:
+                    apps = client.call("app.query", [["name", "=", app_name]], {"select": ["version"]})
+                    new_version = apps[0].get("version", "unknown") if apps else "unknown"
+                except MiddlewareError as e:
+                    new_version = "unknown"
+                    if debug_enabled:
+                        log(f"DEBUG: Could not read new version of {app_name}: {e}")
             log(f"   - New version:    {new_version}")
+            log(f"   - Upgraded in {duration:.1f}s")
             log_content.append(f"{app_name} | {current_version} → {new_version}")
     log("-----------------------------------------")
 
 
-def main() -> int:
-    """Main entry point for the update process."""
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-    config = load_config(script_dir)
+def get_upgrade_images(client: MiddlewareClient, app: dict) -> list:
+    """Return the container images used by the version an app would be upgraded to."""
+    app_name = app.get("name", "")
+    metadata = app.get("metadata") or {}
+    catalog_name = metadata.get("name") or app.get("metadata.name") or app_name
+    train = metadata.get("train") or app.get("metadata.train") or "stable"
+    summary = client.call("app.upgrade_summary", app_name)
+    target_version = summary.get("upgrade_version") or summary.get("latest_version")
+    details = client.call("catalog.get_app_details", catalog_name, {"train": train})
+    version_details = details.get("versions", {}).get(target_version, {})
+    images = (version_details.get("values") or {}).get("images", {})
+    return sorted({
+        f"{image['repository']}:{image['tag']}"
+        for image in images.values()
+        if isinstance(image, dict) and image.get("repository") and image.get("tag")
+    })
+
+
+def run_buffered(func, *args):
+    """Call func in the current thread, returning its result and the log lines it produced."""
+    _log_buffer.lines = []
+    try:
+        return func(*args), _log_buffer.lines
+    finally:
+        _log_buffer.lines = None
+
+
+def prepull_app_images(client: MiddlewareClient, app: dict, config: dict, debug_enabled: bool, dry_run: bool, metrics: RunMetrics = None) -> None:
+    """Pull the images for an app's upgrade target."""
+    app_name = app.get("name", "")
+    timeout = config.get("prepull", {}).get("timeout", 600)
+    try:
+        images = get_upgrade_images(client, app)
+        if not images:
+            log(f"Pre-pull: no images found for {app_name}, they will be pulled during the upgrade")
+        elif dry_run:
+            log(f"Pre-pull: dry-run mode, not pulling for {app_name}: {', '.join(images)}")
+        else:
+            start = time.monotonic()
+            for image in images:
+                if debug_enabled:
+                    log(f"DEBUG: Pulling {image} for {app_name}")
+                client.run_job("app.image.pull", {"image": image}, timeout=timeout)
+            log(f"Pre-pull: pulled {len(images)} image(s) for {app_name} in {time.monotonic() - start:.1f}s")
+            if metrics:
+                metrics.record_app(app_name, "pull", time.monotonic() - start)
+    except MiddlewareError as e:
+        log(f"Pre-pull: failed for {app_name}, images will be pulled during the upgrade: {e}")
+
+
+def prepull_images(client: MiddlewareClient, apps: list, config: dict, debug_enabled: bool, dry_run: bool, metrics: RunMetrics = None) -> None:
+    """Pull upgrade images for all apps ahead of the upgrades, with prepull.max_workers apps at a time."""
+    max_workers = max(1, int(config.get("prepull", {}).get("max_workers", 2)))
+    log(f"Pre-pulling images for {len(apps)} app(s)...")
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(run_buffered, prepull_app_images, client, app, config, debug_enabled, dry_run, metrics)
+            for app in apps
+        ]
+        for future in as_completed(futures):
+            _, lines = future.result()
+            emit_lines(lines)
+    log(f"Pre-pull finished in {time.monotonic() - start:.1f}s")
+    log("-----------------------------------------")
+
+
+def upgrade_app_buffered(client: MiddlewareClient, app: dict, config: dict, debug_enabled: bool, dry_run: bool, metrics: RunMetrics = None) -> list:
+    """Run upgrade_app in a worker thread, returning its log_content entries."""
+    app_log_content = []
+    try:
+        upgrade_app(client, app, config, app_log_content, debug_enabled, dry_run, metrics)
+    except Exception as e:
+        log(f"   - Error upgrading {app.get('name', '')}: {e}")
+        log("-----------------------------------------")
+    return app_log_content
+
+
+def upgrade_apps_concurrently(client: MiddlewareClient, apps: list, config: dict, log_content: list, debug_enabled: bool, dry_run: bool, max_workers: int, metrics: RunMetrics = None) -> list:
+    """Upgrade apps using a bounded worker pool. Returns the names of the apps upgraded.
+
+    apps is the plan from build_upgrade_plan. Whenever a worker is free, the first app in
+    plan order is started whose dependencies have finished and whose weight fits under
+    schedule.max_weight together with the apps still running. An app heavier than
+    max_weight runs alone, and an app whose dependency failed is skipped.
+    """
+    max_weight = config.get("schedule", {}).get("max_weight", max_workers)
+    names = [app.get("name", "") for app in apps]
+    position = {name: index for index, name in enumerate(names)}
+    hints = {name: get_schedule_hints(config, name) for name in names}
+    # Only dependencies planned earlier count, which also settles any cycle build_upgrade_plan broke
+    blockers = {
+        name: [dep for dep in hints[name]["depends_on"] if dep in position and position[dep] < position[name]]
+        for name in names
+    }
+    results = {}
+    pending = list(apps)
+    running = {}
+    running_weight = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            for app in list(pending):
+                if len(running) >= max_workers:
+                    break
+                name = app.get("name", "")
+                failed_deps = [dep for dep in blockers[name] if dep in results and not results[dep]]
+                if failed_deps:
+                    log(f"Skipping {name}: dependency {', '.join(failed_deps)} failed to upgrade")
+                    log("-----------------------------------------")
+                    results[name] = []
+                    pending.remove(app)
+                    continue
+                weight = hints[name]["weight"]
+                if any(dep not in results for dep in blockers[name]) or (running and running_weight + weight > max_weight):
+                    continue
+                pending.remove(app)
+                future = executor.submit(run_buffered, upgrade_app_buffered, client, app, config, debug_enabled, dry_run, metrics)
+                running[future] = name
+                running_weight += weight
+            if not running:
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                running_weight -= hints[name]["weight"]
+                app_log_content, lines = future.result()
+                results[name] = app_log_content
+                emit_lines(lines)
+    upgraded = []
+    for name in names:
+        if results.get(name):
+            log_content.extend(results[name])
+            upgraded.append(name)
+    return upgraded
+
+
+def get_schedule_hints(config: dict, app_name: str) -> dict:
+    """Return the scheduling hints for an app from schedule.apps, with defaults filled in."""
+    hints = config.get("schedule", {}).get("apps", {}).get(app_name, {})
+    return {
+        "priority": hints.get("priority", 0),
+        "weight": max(1, hints.get("weight", 1)),
+        "depends_on": list(hints.get("depends_on", [])),
+    }
+
+
+def build_upgrade_plan(apps: list, config: dict) -> list:
+    """Return the apps in the order they should be started.
+
+    An app comes after every app it depends on (that is also being upgraded). Among the
+    apps whose dependencies are planned, the highest priority comes first, then the
+    heaviest so long upgrades start early, then the app.query order.
+    """
+    names = {app.get("name", "") for app in apps}
+    hints = {app.get("name", ""): get_schedule_hints(config, app.get("name", "")) for app in apps}
+    order = {app.get("name", ""): index for index, app in enumerate(apps)}
+    rank = lambda app: (-hints[app.get("name", "")]["priority"], -hints[app.get("name", "")]["weight"], order[app.get("name", "")])
+    remaining = list(apps)
+    planned = set()
+    plan = []
+    while remaining:
+        ready = [
+            app for app in remaining
+            if all(dep in planned or dep not in names or dep == app.get("name", "") for dep in hints[app.get("name", "")]["depends_on"])
+        ]
+        if not ready:
+            log(f"WARNING: Dependency cycle between {', '.join(app.get('name', '') for app in remaining)}, ignoring dependencies for one app")
+            ready = remaining
+        app = min(ready, key=rank)
+        plan.append(app)
+        planned.add(app.get("name", ""))
+        remaining.remove(app)
+    return plan
+
+
+def log_upgrade_plan(plan: list, config: dict, max_workers: int) -> None:
+    max_weight = config.get("schedule", {}).get("max_weight", max_workers)
+    log(f"Upgrade plan (up to {max_workers} at a time, total weight {max_weight}; each app starts as soon as a worker is free):")
+    for number, app in enumerate(plan, start=1):
+        hints = get_schedule_hints(config, app.get("name", ""))
+        details = f"priority {hints['priority']}, weight {hints['weight']}"
+        if hints["depends_on"]:
+            details += f", after {', '.join(hints['depends_on'])}"
+        log(f"   {number}. {app.get('name', '')} ({details})")
+    log("-----------------------------------------")
+
+
+def sync_catalog(client: MiddlewareClient, config: dict, state: dict, force_sync: bool, debug_enabled: bool) -> None:
+    """Run catalog.sync unless a successful sync happened within catalog.min_sync_interval seconds."""
+    min_interval = config.get("catalog", {}).get("min_sync_interval", 0)
+    last_sync = state.get("catalog_sync", {})
+    age = time.time() - last_sync.get("timestamp", 0)
+    if not force_sync and last_sync.get("success") and age < min_interval:
+        log(f"Skipping catalog sync, last synced {age:.0f}s ago (minimum interval {min_interval}s)")
+        return
+    log("Starting catalog sync...")
+    start = time.monotonic()
+    try:
+        result = client.run_job("catalog.sync")
+        success = True
+    except MiddlewareError as e:
+        log(f"Catalog sync failed: {e}")
+        result = str(e)
+        success = False
+    duration = time.monotonic() - start
+    if debug_enabled:
+        log(f"DEBUG: Catalog sync finished in {duration:.1f}s")
+    state["catalog_sync"] = {
+        "timestamp": time.time(),
+        "time": datetime.datetime.now().isoformat(timespec="seconds"),
+        "success": success,
+        "duration": round(duration, 3),
+        "result": result,
+    }
+
+
+def run_updates(client: MiddlewareClient, config: dict, state_path: str, force_sync: bool = False, notify: bool = True) -> dict:
+    """Run one update pass, timing each phase and exporting the run metrics if enabled. Returns the run report."""
+    metrics = RunMetrics()
+    poll_attempts = client.poll_attempts
+    with metrics.span("total"):
+        exit_code = perform_updates(client, config, state_path, force_sync, metrics, notify)
+    metrics.counters["poll_attempts"] = client.poll_attempts - poll_attempts
+    report = metrics.to_report(config.get("hostname", socket.gethostname()), exit_code)
+    if config.get("debug", {}).get("enabled", False):
+        log(f"DEBUG: Phase timings: {report['spans']}")
+    export_metrics(config, os.path.dirname(state_path), report)
+    return report
+
+
+def perform_updates(client: MiddlewareClient, config: dict, state_path: str, force_sync: bool, metrics: RunMetrics, notify: bool = True) -> int:
+    """Sync the catalog, then upgrade every eligible app and send notifications."""
     hostname = config.get("hostname", socket.gethostname())
     debug_enabled = config.get("debug", {}).get("enabled", False)
     dry_run = config.get("debug", {}).get("dry_run", False)
     discord_enabled = config.get("discord", {}).get("enabled", False)
-    discord_webhook = config.get("discord", {}).get("webhook_url", "")
     slack_enabled = config.get("slack", {}).get("enabled", False)
-    slack_webhook = config.get("slack", {}).get("webhook_url", "")
     excluded_apps = config.get("exclude", {}).get("apps", [])
+    max_workers = max(1, int(config.get("upgrade", {}).get("max_workers", 1)))
     if debug_enabled:
         log(f"DEBUG: Config loaded - hostname: {hostname}, discord_enabled: {discord_enabled}, slack_enabled: {slack_enabled}, dry_run: {dry_run}")
         log(f"DEBUG: Excluded apps: {excluded_apps}")
-    log("Starting catalog sync...")
-    run_command("midclt call catalog.sync")
+        log(f"DEBUG: Upgrade workers: {max_workers}")
+    state = load_state(state_path)
+    with metrics.span("catalog_sync"):
+        sync_catalog(client, config, state, force_sync, debug_enabled)
+    save_state(state_path, state)
     log("-----------------------------------------")
     log("Checking for non-custom apps with available upgrades...")
-    apps_json = run_command("midclt call app.query")
-    if not apps_json:
+    query_start = time.monotonic()
+    try:
+        with metrics.span("app_query"):
+            apps_data = client.call("app.query", APP_QUERY_FILTERS, APP_QUERY_OPTIONS)
+    except MiddlewareError as e:
+        log(f"Failed to query apps: {e}")
+        return 1
+    if apps_data is None:
         log("Failed to query apps")
         return 1
-    apps_data = json.loads(apps_json)
+    if debug_enabled:
+        log(f"DEBUG: app.query returned {len(apps_data)} app(s), "
+            f"{len(json.dumps(apps_data))} bytes in {(time.monotonic() - query_start) * 1000:.0f}ms")
     upgradable_apps = [
         app for app in apps_data
         if not app.get("custom_app", False) and app.get("upgrade_available", False)
     ]
+    metrics.counters["apps_found"] = len(upgradable_apps)
     if not upgradable_apps:
         log("No updates available for non-custom applications")
         log("-----------------------------------------")
@@ -213,33 +889,271 @@ def main() -> int:
     for app in upgradable_apps:
         log(f"• {app.get('name', '')} (Current: {app.get('version', '')})")
     log("-----------------------------------------")
-    total_upgrades = 0
-    log_content = []
+    if config.get("prepull", {}).get("enabled", False):
+        with metrics.span("prepull"):
+            prepull_images(client, [app for app in upgradable_apps if app.get("name") not in excluded_apps],
+                           config, debug_enabled, dry_run, metrics)
+    apps_to_upgrade = []
     for app in upgradable_apps:
-        before_count = len(log_content)
-        upgrade_app(app, config, log_content, debug_enabled, dry_run)
-        if len(log_content) > before_count:
-            total_upgrades += 1
+        if app.get("name", "") in excluded_apps:
+            log(f"Skipping excluded app: {app.get('name', '')}")
+            log("-----------------------------------------")
+        else:
+            apps_to_upgrade.append(app)
+    metrics.counters["apps_excluded"] = len(upgradable_apps) - len(apps_to_upgrade)
+    plan = build_upgrade_plan(apps_to_upgrade, config)
+    if dry_run or debug_enabled:
+        log_upgrade_plan(plan, config, max_workers)
+    log_content = []
+    with metrics.span("upgrades"):
+        upgraded = upgrade_apps_concurrently(client, plan, config, log_content, debug_enabled, dry_run, max_workers, metrics)
+    total_upgrades = len(upgraded)
+    metrics.counters["apps_upgraded"] = total_upgrades
+    metrics.counters["apps_failed"] = len(plan) - total_upgrades
+    metrics.upgrades = log_content
     log(f"Successfully upgraded {total_upgrades} app(s)")
-    if total_upgrades > 0:
-        if discord_enabled:
-            message = f"[{hostname}] "
-            if dry_run:
-                message += f"(Dry Run) Would have upgraded {total_upgrades} app(s):\n" + "\n".join(log_content)
-            else:
-                message += f"Successfully upgraded {total_upgrades} app(s):\n" + "\n".join(log_content)
-            send_webhook_notification(discord_webhook, message)
-        if slack_enabled:
-            message = f"[{hostname}] "
-            if dry_run:
-                message += f"(Dry Run) Would have upgraded {total_upgrades} app(s):\n" + "\n".join(log_content)
-            else:
-                message += f"Successfully upgraded {total_upgrades} app(s):\n" + "\n".join(log_content)
-            send_webhook_notification(slack_webhook, message)
+    if total_upgrades > 0 and notify:
+        if dry_run:
+            header = f"[{hostname}] (Dry Run) Would have upgraded {total_upgrades} app(s):"
+        else:
+            header = f"[{hostname}] Successfully upgraded {total_upgrades} app(s):"
+        with metrics.span("notifications"):
+            send_notifications(config, header, log_content)
     log("Script execution completed")
     return 0
 
 
+def parse_window_time(value: str) -> datetime.time:
+    hours, minutes = value.split(":", 1)
+    return datetime.time(int(hours), int(minutes))
+
+
+def seconds_until_window(window: dict, now: datetime.datetime) -> float:
+    """Return 0 if now is inside the maintenance window, otherwise seconds until it next opens.
+
+    The window is {"start": "HH:MM", "end": "HH:MM", "days": ["mon", ...]}. An end before
+    the start wraps past midnight, and days (default: every day) refer to the day the window opens.
+    """
+    if not window or not window.get("start") or not window.get("end"):
+        return 0
+    start = parse_window_time(window["start"])
+    end = parse_window_time(window["end"])
+    days = [day.lower()[:3] for day in window.get("days", [])]
+    weekdays = ["mon", "tue", "wed", "thu", "fri", "sat", "sun"]
+
+    def opens_on(date: datetime.date) -> bool:
+        return not days or weekdays[date.weekday()] in days
+
+    for offset in (-1, 0):
+        open_date = now.date() + datetime.timedelta(days=offset)
+        if not opens_on(open_date):
+            continue
+        opened = datetime.datetime.combine(open_date, start)
+        closed = datetime.datetime.combine(open_date, end)
+        if end <= start:
+            closed += datetime.timedelta(days=1)
+        if opened <= now < closed:
+            return 0
+    for offset in range(0, 8):
+        open_date = now.date() + datetime.timedelta(days=offset)
+        opened = datetime.datetime.combine(open_date, start)
+        if opens_on(open_date) and opened > now:
+            return (opened - now).total_seconds()
+    return 0
+
+
+def run_daemon(config: dict, state_path: str, transport: str, force_sync: bool = False) -> int:
+    """Stay resident, upgrading apps when they become upgradable inside the maintenance window.
+
+    Runs are triggered every daemon.check_interval seconds and, over the websocket transport,
+    by app and catalog.sync job events. Bursts of events are debounced into a single run.
+    The websocket session is pinged while idle and after every run, and reopened if it dropped.
+    """
+    daemon_config = config.get("daemon", {})
+    check_interval = daemon_config.get("check_interval", 3600)
+    debounce = daemon_config.get("debounce", 60)
+    window = daemon_config.get("window", {})
+    debug_enabled = config.get("debug", {}).get("enabled", False)
+    wake = threading.Event()
+
+    def on_event(mtype, **message):
+        fields = message.get("fields") or {}
+        if message.get("collection") == "core.get_jobs":
+            if fields.get("method") != "catalog.sync" or fields.get("state") != "SUCCESS":
+                return
+        elif not fields.get("upgrade_available") or fields.get("custom_app"):
+            return
+        if debug_enabled:
+            log(f"DEBUG: {message.get('collection')} {mtype} event for {message.get('id')}")
+        wake.set()
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    log(f"Starting daemon mode (check interval {check_interval}s, debounce {debounce}s)")
+    next_check = 0.0
+    while True:
+        try:
+            with MiddlewareClient(transport, debug_enabled) as client:
+                if client.fallback_reason:
+                    log(f"WARNING: Websocket client unavailable ({client.fallback_reason}), "
+                        f"falling back to midclt polling every {check_interval}s")
+                if client.subscribe("app.query", on_event) and client.subscribe("core.get_jobs", on_event):
+                    log("Listening for app and catalog events")
+                else:
+                    log(f"Events unavailable over {client.transport}, checking every {check_interval}s")
+                while True:
+                    woken = wake.wait(timeout=min(max(0.0, next_check - time.monotonic()), DAEMON_PING_INTERVAL))
+                    if not woken and time.monotonic() < next_check:
+                        # A dropped session delivers no events, so notice it while idle
+                        client.ensure_connected()
+                        continue
+                    if woken:
+                        wake.clear()
+                        while wake.wait(timeout=debounce):
+                            wake.clear()
+                    wait = seconds_until_window(window, datetime.datetime.now())
+                    if wait > 0:
+                        log(f"Outside maintenance window, next check in {wait:.0f}s")
+                        next_check = time.monotonic() + wait
+                        continue
+                    run_updates(client, config, state_path, force_sync)
+                    # Drop events caused by the run itself, such as its own catalog.sync finishing
+                    wake.clear()
+                    # Failed calls are logged and swallowed by the run, so check the session
+                    # before scheduling the next one; a dropped session reruns after reconnecting.
+                    client.ensure_connected()
+                    force_sync = False
+                    next_check = time.monotonic() + check_interval
+                    if client.fallback_reason:
+                        # Try the websocket again before the next check
+                        break
+        except MiddlewareError as e:
+            log(f"Middleware connection error: {e}, reconnecting in 30s")
+            time.sleep(30)
+
+
+def merge_config(base: dict, overrides: dict) -> dict:
+    """Return a copy of base with overrides applied, merging nested sections.
+
+    Nested sections are copied too, so changing the result never changes base.
+    """
+    merged = {key: merge_config(value, {}) if isinstance(value, dict) else value for key, value in base.items()}
+    for key, value in overrides.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = merge_config(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+
+def load_fleet_inventory(inventory_path: str) -> dict:
+    with open(inventory_path, 'r') as f:
+        inventory = json.load(f)
+    for host in inventory.get("hosts", []):
+        if not host.get("name") or not host.get("uri"):
+            raise ValueError(f"Fleet host entries need a name and uri: {host}")
+        if host.get("api_key_file"):
+            with open(host["api_key_file"], 'r') as f:
+                host["api_key"] = f.read().strip()
+    return inventory
+
+
+def update_fleet_host(host: dict, config: dict, script_dir: str, force_sync: bool) -> dict:
+    """Run the update flow against one remote host, returning its run report."""
+    name = host["name"]
+    host_config = merge_config(config, host.get("config", {}))
+    host_config["hostname"] = name
+    metrics_config = dict(host_config.get("metrics", {}))
+    host_config["metrics"] = metrics_config
+    metrics_config["report_file"] = f"update_apps.{name}.report.json"
+    metrics_config["history_file"] = f"update_apps.{name}.history.jsonl"
+    if metrics_config.get("textfile"):
+        stem, extension = os.path.splitext(metrics_config["textfile"])
+        metrics_config["textfile"] = f"{stem}_{name}{extension}"
+    debug_enabled = host_config.get("debug", {}).get("enabled", False)
+    log(f"===== {name} ({host['uri']}) =====")
+    try:
+        with MiddlewareClient("websocket", debug_enabled, host["uri"], host.get("api_key"), host.get("verify_ssl", True)) as client:
+            return run_updates(client, host_config, os.path.join(script_dir, f"update_apps.{name}.state.json"), force_sync, notify=False)
+    except MiddlewareError as e:
+        log(f"Error updating {name}: {e}")
+        return {"hostname": name, "exit_code": 1, "error": str(e), "upgrades": [], "counters": {}}
+
+
+def run_fleet(inventory_path: str, config: dict, script_dir: str, force_sync: bool = False) -> int:
+    """Update every host in the inventory concurrently and send one combined notification."""
+    inventory = load_fleet_inventory(inventory_path)
+    hosts = inventory.get("hosts", [])
+    if not hosts:
+        log("No hosts found in fleet inventory")
+        return 1
+    max_workers = max(1, int(inventory.get("max_workers", len(hosts))))
+    log(f"Updating {len(hosts)} host(s), {max_workers} at a time...")
+    start = time.monotonic()
+    reports = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(run_buffered, update_fleet_host, host, config, script_dir, force_sync): host["name"]
+            for host in hosts
+        }
+        for future in as_completed(futures):
+            reports[futures[future]], lines = future.result()
+            emit_lines(lines)
+    log(f"Fleet update finished in {time.monotonic() - start:.1f}s")
+    summary = []
+    total_upgrades = 0
+    failed_hosts = []
+    for host in hosts:
+        report = reports[host["name"]]
+        upgrades = report.get("upgrades", [])
+        total_upgrades += len(upgrades)
+        summary.extend(f"[{host['name']}] {line}" for line in upgrades)
+        if report.get("exit_code"):
+            failed_hosts.append(host["name"])
+            summary.append(f"[{host['name']}] Update run failed{': ' + report['error'] if report.get('error') else ''}")
+        log(f"{host['name']}: {len(upgrades)} app(s) upgraded, {report.get('counters', {}).get('apps_failed', 0)} failed"
+            f"{' (run failed)' if report.get('exit_code') else ''}")
+    if total_upgrades > 0 or failed_hosts:
+        dry_run = config.get("debug", {}).get("dry_run", False)
+        action = "(Dry Run) Would have upgraded" if dry_run else "Upgraded"
+        header = f"[Fleet] {action} {total_upgrades} app(s) across {len(hosts)} host(s)"
+        if failed_hosts:
+            header += f", {len(failed_hosts)} host(s) failed"
+        send_notifications(config, header + ":", summary)
+    return 1 if failed_hosts else 0
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Automatic updates for non-custom TrueNAS apps.")
+    parser.add_argument("--compare-transports", type=int, metavar="N", nargs="?", const=20,
+                        help="Time N middleware calls over midclt and the websocket client, then exit (default: 20)")
+    parser.add_argument("--force-sync", action="store_true",
+                        help="Run catalog.sync even if the last sync is within catalog.min_sync_interval")
+    parser.add_argument("--fleet", metavar="INVENTORY",
+                        help="Update every host in a JSON host inventory over the remote websocket API")
+    parser.add_argument("--daemon", action="store_true",
+                        help="Stay resident and upgrade apps as they become upgradable (see the daemon config section)")
+    return parser.parse_args()
+
+
+def main() -> int:
+    """Main entry point for the update process."""
+    args = parse_args()
+    if args.compare_transports:
+        compare_transports(args.compare_transports)
+        return 0
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    config = load_config(script_dir)
+    transport = config.get("middleware", {}).get("transport", "auto")
+    debug_enabled = config.get("debug", {}).get("enabled", False)
+    state_path = os.path.join(script_dir, STATE_FILE)
+    if args.fleet:
+        return run_fleet(args.fleet, config, script_dir, args.force_sync)
+    if args.daemon:
+        return run_daemon(config, state_path, transport, args.force_sync)
+    with MiddlewareClient(transport, debug_enabled) as client:
+        return run_updates(client, config, state_path, args.force_sync)["exit_code"]
+
+
 if __name__ == "__main__":
     try:
         sys.exit(main())